@@ -1,5 +1,6 @@
 """Configuration for the application."""
-from os import environ
+import tempfile
+from os import environ, path
 from pathlib import Path
 
 from dotenv import dotenv_values
@@ -13,12 +14,14 @@ LOCAL_ENV_FILE = env_path.exists()
 config = dotenv_values(".env")
 
 
-def get_env(key):
+def get_env(key, optional=False):
     """Return environment variable from .env or native environment."""
     if LOCAL_ENV_FILE:
         return config.get(key)
 
     if key not in environ:
+        if optional:
+            return None
         raise ValueError(f"Environment variable {key} not set.")
 
     return environ.get(key)
@@ -27,3 +30,11 @@ def get_env(key):
 FAIRHUB_ACCESS_TOKEN = get_env("FAIRHUB_ACCESS_TOKEN")
 AZURE_STORAGE_ACCESS_KEY = get_env("AZURE_STORAGE_ACCESS_KEY")
 AZURE_STORAGE_CONNECTION_STRING = get_env("AZURE_STORAGE_CONNECTION_STRING")
+
+# Local cache of downloaded blobs, shared by the workers on an instance
+BLOB_CACHE_DIR = get_env("BLOB_CACHE_DIR", optional=True) or path.join(
+    tempfile.gettempdir(), "fairhub-blob-cache"
+)
+BLOB_CACHE_MAX_BYTES = int(
+    get_env("BLOB_CACHE_MAX_BYTES", optional=True) or 2 * 1024**3
+)
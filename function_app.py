@@ -7,12 +7,31 @@ from stage_one.env_sensor_pipeline import pipeline as stage_one_env_sensor_pipel
 from stage_one.img_identifier_pipeline import (
     pipeline as stage_one_img_identifier_pipeline,
 )
+from utils.instrumentation import configure_exporter
 
 app = func.FunctionApp()
 
+configure_exporter()
+
 logging.debug("Function app created")
 
 
+def sampling_params(req: func.HttpRequest):
+    """Return the `sample` (files per stratum) and `seed` query parameters.
+
+    Raises ValueError unless `sample` is absent or a positive integer.
+    """
+    sample = req.params.get("sample") or None
+    seed = req.params.get("seed", "0")
+
+    if sample is not None:
+        sample = int(sample)
+        if sample < 1:
+            raise ValueError("sample must be at least 1")
+
+    return sample, int(seed)
+
+
 @app.route(route="hello", auth_level=func.AuthLevel.ANONYMOUS)
 def hello(
     req: func.HttpRequest,
@@ -35,9 +54,20 @@ def preprocess_stage_one_env(req: func.HttpRequest) -> func.HttpResponse:
     """
 
     try:
-        stage_one_env_sensor_pipeline()
-    except Exception as e:
-        print(f"Exception: {e}")
+        sample_per_stratum, sample_seed = sampling_params(req)
+    except ValueError:
+        return func.HttpResponse(
+            "sample must be a positive integer and seed an integer",
+            status_code=400,
+            mimetype="text/plain",
+        )
+
+    try:
+        stage_one_env_sensor_pipeline(
+            sample_per_stratum=sample_per_stratum, sample_seed=sample_seed
+        )
+    except Exception:
+        logging.exception("Stage one pipeline failed")
 
     return func.HttpResponse("Success", status_code=200, mimetype="text/plain")
 
@@ -51,9 +81,23 @@ def preprocess_stage_one_n_test(req: func.HttpRequest) -> func.HttpResponse:
     POC so this is just a test to see if we can read the files in the stage-1-container.
     """
 
+    whole_archive = req.params.get("mode") == "archive"
+    try:
+        sample_per_stratum, sample_seed = sampling_params(req)
+    except ValueError:
+        return func.HttpResponse(
+            "sample must be a positive integer and seed an integer",
+            status_code=400,
+            mimetype="text/plain",
+        )
+
     try:
-        stage_one_img_identifier_pipeline()
-    except Exception as e:
-        print(f"Exception: {e}")
+        stage_one_img_identifier_pipeline(
+            whole_archive=whole_archive,
+            sample_per_stratum=sample_per_stratum,
+            sample_seed=sample_seed,
+        )
+    except Exception:
+        logging.exception("Stage one pipeline failed")
 
     return func.HttpResponse("Success", status_code=200, mimetype="text/plain")
@@ -1,20 +1,20 @@
 """Process environmental sensor data files"""
-import datetime
-import json
 import os
 import tempfile
+import time
 import uuid
 
-import azure.storage.blob as azureblob
-import azure.storage.filedatalake as azurelake
+from utils.instrumentation import RunMetrics
+from utils.sampling import SampleReport, stratified_sample
+from utils.storage import AzureBackend, Storage, default_budgets
+from utils.streaming import JsonArrayWriter, Stage, StreamingPipeline
 
-import config
 
-
-def pipeline():
+def pipeline(sample_per_stratum=None, sample_seed=0):
     """Reads the data in the stage-1-container. Each file name is added to a log file in the logs folder for the study.
     Will also create an output file with a modified name to simulate a processing step.
     POC so this is just a test to see if we can read the files in the stage-1-container.
+    With `sample_per_stratum` only a seeded sample of that many files per site is processed.
     """
 
     def data_identifier(file):
@@ -23,79 +23,100 @@ def pipeline():
         else:
             return "Unknown File Type"
 
+    def site_stratum(path):
+        # sensor file names start with the site name
+        return path.split("/")[-1].split("_")[0]
+
     input_folder = "AI-READI/pooled-data/EnvSensor"
     logs_folder = "AI-READI/logs/"
 
-    sas_token = azureblob.generate_account_sas(
-        account_name="b2aistaging",
-        account_key=config.AZURE_STORAGE_ACCESS_KEY,
-        resource_types=azureblob.ResourceTypes(container=True, object=True),
-        permission=azureblob.AccountSasPermissions(read=True, write=True, list=True),
-        expiry=datetime.datetime.now(datetime.timezone.utc)
-        + datetime.timedelta(hours=1),
-    )
-
-    # Get the blob service client
-    blob_service_client = azureblob.BlobServiceClient(
-        account_url="https://b2aistaging.blob.core.windows.net/",
-        credential=sas_token,
-    )
-
     # Create a temporary folder for this workflow
     workflow_id = uuid.uuid4()
 
-    # Get the list of blobs in the input folder
-    file_system_client = azurelake.FileSystemClient.from_connection_string(
-        config.AZURE_STORAGE_CONNECTION_STRING,
-        file_system_name="stage-1-container",
+    metrics = RunMetrics("env_sensor", workflow_id)
+
+    storage = Storage(
+        AzureBackend.from_config(), budgets=default_budgets(), metrics=metrics
     )
 
-    paths = file_system_client.get_paths(path=input_folder)
+    # discover
+    paths = (name for name, _, _ in storage.iter_files(input_folder))
 
-    str_paths = []
+    def route(path):
+        # get the file name from the path
+        file_name = path.split("/")[-1]
 
-    for path in paths:
-        t = str(path.name)
-        str_paths.append(t)
+        if data_identifier(file_name) == "Environmental Sensor File":
+            metrics.increment("env_sensor_files")
+            yield {"path": path, "started": time.perf_counter()}
+
+    def inspect(item):
+        file_name = item["path"].split("/")[-1]
+        # split the path name by the - character
+        components = file_name.split("_")
+        # extract the metadata from the file name
+        item["metadata"] = {
+            "file_name": file_name,
+            "site_name": components[0],
+            "data_type": components[1],
+            "site_name_2": components[2],
+            "data_type_2": components[3],
+            "date_range": components[4],
+            "prefix": components[5].split("-")[0],
+            "patient_id": components[5].split("-")[1],
+            "sensor_id": os.path.splitext(components[5].split("-")[2])[0],
+        }
+        yield item
+
+    if sample_per_stratum:
+        # stratifying needs the whole listing, but only the names
+        paths, strata = stratified_sample(
+            (
+                path
+                for path in paths
+                if data_identifier(path.split("/")[-1]) == "Environmental Sensor File"
+            ),
+            sample_per_stratum,
+            sample_seed,
+            site_stratum,
+        )
+        sample_report = SampleReport(sample_per_stratum, sample_seed, strata)
 
     # generate temp file for logs
     temp_log_file, temp_log_file_path = tempfile.mkstemp(suffix=".env.log")
+    os.close(temp_log_file)
 
-    extracted_metadata = []
+    with JsonArrayWriter(temp_log_file_path) as log:
 
-    for path in str_paths:
-        # get the file name from the path
-        file_name = path.split("/")[-1]
+        def sink(item):
+            metrics.record_file(item["path"], time.perf_counter() - item["started"])
+
+            metadata = item["metadata"]
+            if sample_per_stratum:
+                sample_report.add(metadata["site_name"], [metadata["data_type"]])
 
-        env_sensor_file = data_identifier(file_name)
-
-        if env_sensor_file == "Environmental Sensor File":
-            # split the path name by the - character
-            components = file_name.split("_")
-            # extract the metadata from the file name
-            extracted_metadata.append(
-                {
-                    "file_name": file_name,
-                    "site_name": components[0],
-                    "data_type": components[1],
-                    "site_name_2": components[2],
-                    "data_type_2": components[3],
-                    "date_range": components[4],
-                    "prefix": components[5].split("-")[0],
-                    "patient_id": components[5].split("-")[1],
-                    "sensor_id": os.path.splitext(components[5].split("-")[2])[0],
-                }
-            )
-
-    # write the paths to the log file
-    with open(temp_log_file_path, mode="w", encoding="utf-8") as f:
-        formatted_text = json.dumps(extracted_metadata, indent=4)
-        f.write(formatted_text)
+            log.write(metadata)
+
+        StreamingPipeline(
+            paths,
+            [Stage("route", route), Stage("inspect", inspect)],
+            sink,
+            metrics=metrics,
+        ).run()
+
+    if sample_per_stratum:
+        metrics.add_section("sampling", sample_report.to_dict())
 
     # upload the log file to the logs folder
-    log_blob_client = blob_service_client.get_blob_client(
-        container="stage-1-container", blob=f"{logs_folder}{workflow_id}.env.log"
+    with metrics.span("upload"):
+        storage.upload_file(f"{logs_folder}{workflow_id}.env.log", temp_log_file_path)
+
+    metrics.add_section("storage", storage.report())
+
+    # upload the run metrics next to the log file
+    storage.upload(
+        f"{logs_folder}{workflow_id}.env.metrics.json",
+        metrics.dumps().encode("utf-8"),
     )
 
-    with open(temp_log_file_path, "rb") as data:
-        log_blob_client.upload_blob(data)
+    metrics.export()
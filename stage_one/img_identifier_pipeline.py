@@ -1,137 +1,254 @@
 """Process environmental sensor data files"""
-import datetime
-import json
+import contextlib
+import logging
 import os
 import tempfile
+import time
 import uuid
 
-import azure.storage.blob as azureblob
-import azure.storage.filedatalake as azurelake
-
 import config
 
+from utils.blob_cache import BlobCache
+from utils.content_sniffing import CSV_ZIP, DICOM, DICOM_ZIP, sniff
 from utils.image_classifying_rules import (
-    process_dicom_zip,
+    ARCHIVE_WORKERS,
     extract_env_info,
+    get_dicom_summary,
+    process_dicom_zip,
+)
+from utils.instrumentation import RunMetrics
+from utils.sampling import (
+    SampleReport,
+    folder_stratum,
+    protocols_of,
+    stratified_sample,
 )
+from utils.storage import AzureBackend, Storage, default_budgets
+from utils.streaming import JsonArrayWriter, Stage, StreamingPipeline
 
+# Archives classified at once, each reading its members on ARCHIVE_WORKERS
+# threads, so decompression threads stay close to the number of CPUs
+CLASSIFY_WORKERS = max(1, (os.cpu_count() or 1) // 2)
 
-def pipeline():
-    """Does something"""
 
-    def data_identifier(zip_file_path):
-        if not zip_file_path.endswith(".zip"):
-            return "Not a zip file"
+def pipeline(whole_archive=False, sample_per_stratum=None, sample_seed=0):
+    """Classify the imaging archives in the pooled data folder.
 
-        elif "ENV" in zip_file_path:
-            return extract_env_info(zip_file_path)
+    With `whole_archive` every DICOM member of an archive is classified and a
+    per-archive manifest is logged instead of a single representative file.
+    With `sample_per_stratum` only a seeded sample of that many files per
+    device and site folder is processed, for quick validation runs.
+    """
+
+    def data_identifier(sniffed, path, local_path, metrics):
+        if sniffed.content_type == CSV_ZIP:
+            # the sensor metadata is in the file name, no download needed
+            if sniffed.expected_type != CSV_ZIP:
+                return "Unknown file type"
+
+            return extract_env_info(path)
+
+        elif sniffed.content_type == DICOM_ZIP:
+            return process_dicom_zip(
+                local_path,
+                metrics=metrics,
+                whole_archive=whole_archive,
+                max_workers=ARCHIVE_WORKERS,
+            )
 
-        elif any(
-            word in zip_file_path
-            for word in [
-                "Optomed",
-                "Eidon",
-                "Maestro",
-                "Triton",
-                "FLIO",
-                "Cirrus",
-                "Spectralis",
-            ]
-        ):
-            return process_dicom_zip(zip_file_path)
+        elif sniffed.content_type == DICOM:
+            try:
+                return get_dicom_summary(local_path)
+            except Exception as e:
+                return {"error": str(e)}
 
         else:
             return "Unknown file type"
 
+    def is_candidate(file):
+        path, size, _ = file
+        file_name = path.split("/")[-1]
+
+        # skip empty files and hidden or metadata files, e.g. .DS_Store
+        if not size or file_name.startswith((".", "_")):
+            return False
+
+        return file_name.lower().endswith((".zip", ".dcm"))
+
     input_folder = "AI-READI/pooled-data"
     logs_folder = "AI-READI/logs/"
 
-    sas_token = azureblob.generate_account_sas(
-        account_name="b2aistaging",
-        account_key=config.AZURE_STORAGE_ACCESS_KEY,
-        resource_types=azureblob.ResourceTypes(container=True, object=True),
-        permission=azureblob.AccountSasPermissions(read=True, write=True, list=True),
-        expiry=datetime.datetime.now(datetime.timezone.utc)
-        + datetime.timedelta(hours=1),
+    # Create a temporary folder for this workflow
+    workflow_id = uuid.uuid4()
+
+    metrics = RunMetrics("img_identifier", workflow_id)
+
+    storage = Storage(
+        AzureBackend.from_config(), budgets=default_budgets(), metrics=metrics
     )
 
-    # Get the blob service client
-    blob_service_client = azureblob.BlobServiceClient(
-        account_url="https://b2aistaging.blob.core.windows.net/",
-        credential=sas_token,
+    cache = BlobCache(
+        config.BLOB_CACHE_DIR, config.BLOB_CACHE_MAX_BYTES, metrics=metrics
     )
 
-    # Create a temporary folder for this workflow
-    workflow_id = uuid.uuid4()
+    stratum_of = folder_stratum(input_folder)
 
-    # Get the list of blobs in the input folder
-    file_system_client = azurelake.FileSystemClient.from_connection_string(
-        config.AZURE_STORAGE_CONNECTION_STRING,
-        file_system_name="stage-1-container",
-    )
+    # discover
+    files = storage.iter_files(input_folder)
 
-    paths = file_system_client.get_paths(path=input_folder)
+    if sample_per_stratum:
+        # stratifying needs the whole listing, but only the names
+        files, strata = stratified_sample(
+            (file for file in files if is_candidate(file)),
+            sample_per_stratum,
+            sample_seed,
+            stratum_of,
+            key=lambda f: f[0],
+        )
+        sample_report = SampleReport(sample_per_stratum, sample_seed, strata)
+
+    def failed(item, stage, error):
+        # one bad file is logged with its error instead of ending the run
+        logging.exception("Failed to %s %s", stage, item["path"])
+        metrics.increment(f"error.{stage}")
+
+        item["file_info"] = {"error": str(error)}
+
+    def route(file):
+        path, size, etag = file
+        item = {
+            "path": path,
+            "etag": etag,
+            "sniffed": None,
+            "started": time.perf_counter(),
+        }
+
+        try:
+            # identify the file from its first bytes before downloading it
+            with metrics.span("sniff"):
+                item["sniffed"] = sniff(
+                    path,
+                    lambda offset, length: storage.download_range(path, offset, length),
+                    size,
+                )
+        except Exception as e:
+            failed(item, "sniff", e)
+            yield item
+            return
+
+        metrics.increment(f"sniff.{item['sniffed'].content_type}")
+        if item["sniffed"].mismatch:
+            metrics.increment("sniff.mismatch")
+
+        yield item
+
+    def fetch(item):
+        if "file_info" in item:
+            yield item
+            return
+
+        if item["sniffed"].content_type in (DICOM_ZIP, DICOM):
+
+            def download():
+                with metrics.span("download"):
+                    return storage.download(item["path"])
+
+            # warm re-runs on this instance are served from local disk; the
+            # entry stays locked against eviction until it is classified
+            stack = contextlib.ExitStack()
+            try:
+                item["local_path"] = stack.enter_context(
+                    cache.open(item["path"], item["etag"], download)
+                )
+            except Exception as e:
+                failed(item, "download", e)
+            else:
+                item["release"] = stack.close
+
+        yield item
+
+    def classify(item):
+        if "file_info" in item:
+            yield item
+            return
+
+        try:
+            item["file_info"] = data_identifier(
+                item["sniffed"], item["path"], item.get("local_path"), metrics
+            )
+        except Exception as e:
+            failed(item, "classify", e)
+        finally:
+            if "release" in item:
+                item["release"]()
 
-    str_paths = []
+        yield item
 
-    for path in paths:
-        t = str(path.name)
-        str_paths.append(t)
+    def discard(item):
+        # fetched items left behind by a failed run still lock their entry
+        if isinstance(item, dict) and "release" in item:
+            item["release"]()
 
     # generate temp file for logs
     temp_log_file, temp_log_file_path = tempfile.mkstemp(suffix=".n.test.log")
+    os.close(temp_log_file)
 
-    # Create a temporary folder on the local machine
-    temp_folder_path = tempfile.mkdtemp()
-
-    extracted_metadata = []
+    mismatches = []
 
-    for path in str_paths:
-        print(path)
+    with JsonArrayWriter(temp_log_file_path) as log:
 
-        # get the file name from the path
-        file_name = path.split("/")[-1]
-
-        # skip if the path is a folder (check if extension is empty)
-        if not file_name.split(".")[-1]:
-            continue
+        def sink(item):
+            path = item["path"]
+            metrics.record_file(path, time.perf_counter() - item["started"])
 
-        # download the file to the temp folder
-        blob_client = blob_service_client.get_blob_client(
-            container="stage-1-container", blob=path
-        )
+            sniffed = item["sniffed"]
+            record = {
+                "file_name": path.split("/")[-1],
+                "path": path,
+                "content": sniffed.to_dict() if sniffed else None,
+                "file_info": item["file_info"],
+            }
 
-        download_path = os.path.join(temp_folder_path, file_name)
+            if sniffed and sniffed.mismatch:
+                mismatches.append({"path": path, **record["content"]})
 
-        with open(download_path, "wb") as download_file:
-            download_file.write(blob_client.download_blob().readall())
+            if sample_per_stratum:
+                sample_report.add(stratum_of(path), protocols_of(item["file_info"]))
 
-            # process the file
+            log.write(record)
 
-            file_info = data_identifier(download_path)
+        # sniffing and downloads are gated by the storage controller,
+        # classifying is CPU bound
+        StreamingPipeline(
+            files,
+            [
+                Stage("route", route, workers=8),
+                Stage("fetch", fetch, workers=4),
+                Stage("classify", classify, workers=CLASSIFY_WORKERS),
+            ],
+            sink,
+            metrics=metrics,
+            discard=discard,
+        ).run()
 
-            extracted_metadata.append(
-                {
-                    "file_name": file_name,
-                    "file_info": file_info,
-                }
-            )
+    metrics.add_section("content_mismatches", mismatches)
 
-        # remove the file from the temp folder
-        os.remove(download_path)
+    if sample_per_stratum:
+        metrics.add_section("sampling", sample_report.to_dict())
 
-    # remove the temp folder
-    os.rmdir(temp_folder_path)
+    # upload the log file to the logs folder
+    with metrics.span("upload"):
+        storage.upload_file(
+            f"{logs_folder}{workflow_id}.n.test.log", temp_log_file_path
+        )
 
-    # write the paths to the log file
-    with open(temp_log_file_path, mode="w", encoding="utf-8") as f:
-        formatted_text = json.dumps(extracted_metadata, indent=4)
-        f.write(formatted_text)
+    metrics.add_section("storage", storage.report())
+    metrics.add_section("blob_cache", cache.report())
 
-    # upload the log file to the logs folder
-    log_blob_client = blob_service_client.get_blob_client(
-        container="stage-1-container", blob=f"{logs_folder}{workflow_id}.n.test.log"
+    # upload the run metrics next to the log file
+    storage.upload(
+        f"{logs_folder}{workflow_id}.n.test.metrics.json",
+        metrics.dumps().encode("utf-8"),
     )
 
-    with open(temp_log_file_path, "rb") as data:
-        log_blob_client.upload_blob(data)
+    metrics.export()
@@ -0,0 +1,7 @@
+"""Shared test setup."""
+import os
+
+# config reads these at import time, the tests never reach a storage account
+os.environ.setdefault("FAIRHUB_ACCESS_TOKEN", "test")
+os.environ.setdefault("AZURE_STORAGE_ACCESS_KEY", "test")
+os.environ.setdefault("AZURE_STORAGE_CONNECTION_STRING", "test")
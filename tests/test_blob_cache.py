@@ -0,0 +1,194 @@
+"""Tests for the on-disk blob cache."""
+import os
+import shutil
+import threading
+
+from utils import blob_cache
+from utils.blob_cache import BlobCache, file_lock
+
+
+def fetcher(data, calls):
+    def fetch():
+        calls.append(data)
+        return data
+
+    return fetch
+
+
+def lock_files(root):
+    return sorted(
+        name
+        for name in os.listdir(root)
+        if name.endswith(".lock") and name != "eviction.lock"
+    )
+
+
+def test_open_hits_after_a_miss(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=1000)
+    calls = []
+
+    for _ in range(3):
+        with cache.open("data/a.bin", '"1"', fetcher(b"a" * 10, calls)) as path:
+            assert os.path.basename(path) == "a.bin"
+            with open(path, "rb") as f:
+                assert f.read() == b"a" * 10
+
+    assert len(calls) == 1
+    report = cache.report()
+    assert (report["hits"], report["misses"], report["bytes_hit"]) == (2, 1, 20)
+
+
+def test_changed_etag_is_fetched_again(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=1000)
+    calls = []
+
+    with cache.open("data/a.bin", '"1"', fetcher(b"old", calls)):
+        pass
+    with cache.open("data/a.bin", '"2"', fetcher(b"new", calls)) as path:
+        with open(path, "rb") as f:
+            assert f.read() == b"new"
+
+    assert calls == [b"old", b"new"]
+
+
+def test_entry_evicted_between_locks_counts_one_miss(tmp_path, monkeypatch):
+    cache = BlobCache(str(tmp_path), max_bytes=1000)
+    calls = []
+
+    with cache.open("data/a.bin", "1", fetcher(b"a", calls)):
+        pass
+
+    def evicting_lock(lock_path, shared=False, blocking=True):
+        if shared:
+            entry_folder = os.path.join(str(tmp_path), cache.key("data/a.bin", "1"))
+            shutil.rmtree(entry_folder, ignore_errors=True)
+        return file_lock(lock_path, shared, blocking)
+
+    monkeypatch.setattr(blob_cache, "file_lock", evicting_lock)
+
+    with cache.open("data/a.bin", "1", fetcher(b"a", calls)) as path:
+        assert os.path.exists(path)
+
+    report = cache.report()
+    assert (report["hits"], report["misses"], report["bytes_hit"]) == (0, 2, 0)
+    assert len(calls) == 2
+
+
+def test_evicts_least_recently_used_under_budget(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=25)
+    calls = []
+
+    for name in ["a", "b"]:
+        with cache.open(f"data/{name}.bin", "1", fetcher(b"x" * 10, calls)):
+            pass
+
+    # b was used before a
+    b_path = os.path.join(str(tmp_path), cache.key("data/b.bin", "1"), "b.bin")
+    os.utime(b_path, (0, 0))
+
+    with cache.open("data/c.bin", "1", fetcher(b"x" * 10, calls)):
+        pass
+
+    keys = {key for _, _, key in cache.entries()}
+    assert keys == {cache.key("data/a.bin", "1"), cache.key("data/c.bin", "1")}
+    assert sum(size for _, size, _ in cache.entries()) <= 25
+    assert cache.report()["evictions"] == 1
+
+    # the evicted entry's lock file goes with it
+    assert f"{cache.key('data/b.bin', '1')}.lock" not in lock_files(str(tmp_path))
+
+
+def test_entries_in_use_are_not_evicted(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=5)
+    calls = []
+
+    with cache.open("data/a.bin", "1", fetcher(b"x" * 10, calls)) as a_path:
+        with cache.open("data/b.bin", "1", fetcher(b"x" * 10, calls)):
+            assert os.path.exists(a_path)
+
+    cache.evict()
+    assert cache.entries() == []
+    assert lock_files(str(tmp_path)) == []
+
+
+def test_evict_sweeps_failed_writes_and_orphan_locks(tmp_path):
+    root = str(tmp_path)
+    cache = BlobCache(root, max_bytes=1000)
+
+    key = cache.key("data/a.bin", "1")
+    os.makedirs(os.path.join(root, key))
+    with open(os.path.join(root, key, "a.bin.1.2.tmp"), "wb") as f:
+        f.write(b"partial")
+    with open(os.path.join(root, f"{'0' * 64}.lock"), "wb"):
+        pass
+
+    with cache.open("data/b.bin", "1", fetcher(b"b", [])):
+        pass
+
+    assert not os.path.exists(os.path.join(root, key))
+    assert lock_files(root) == [f"{cache.key('data/b.bin', '1')}.lock"]
+
+
+def test_sweep_skips_writes_in_progress(tmp_path):
+    root = str(tmp_path)
+    cache = BlobCache(root, max_bytes=1000)
+
+    key = cache.key("data/a.bin", "1")
+    temp_path = os.path.join(root, key, "a.bin.1.2.tmp")
+    os.makedirs(os.path.dirname(temp_path))
+    with open(temp_path, "wb"):
+        pass
+
+    with file_lock(os.path.join(root, f"{key}.lock")):
+        cache.sweep()
+        assert os.path.exists(temp_path)
+
+
+def test_file_lock_is_retaken_after_unlink(tmp_path):
+    lock_path = str(tmp_path / "entry.lock")
+    acquired = threading.Event()
+
+    with file_lock(lock_path):
+
+        def waiter():
+            with file_lock(lock_path):
+                acquired.set()
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+
+        # the waiter opened the file that is about to be unlinked
+        thread.join(0.1)
+        os.unlink(lock_path)
+
+    thread.join()
+    assert acquired.is_set()
+    assert os.path.exists(lock_path)
+
+
+def test_concurrent_readers_share_entries(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=40)
+    errors = []
+
+    def worker(offset):
+        try:
+            for index in range(50):
+                name = f"data/{(offset + index) % 6}.bin"
+                with cache.open(name, "1", lambda: b"y" * 10) as path:
+                    with open(path, "rb") as f:
+                        assert f.read() == b"y" * 10
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert cache.hits + cache.misses == 6 * 50
+
+    # entries skipped while in use are evicted once released
+    cache.evict()
+    assert sum(size for _, size, _ in cache.entries()) <= 40
@@ -0,0 +1,147 @@
+"""Tests for content sniffing and the range-read zip directory parser."""
+import io
+import zipfile
+
+import pytest
+
+from utils.content_sniffing import (
+    CSV,
+    CSV_ZIP,
+    DICOM,
+    DICOM_ZIP,
+    TAIL_BYTES,
+    UNKNOWN,
+    ZIP,
+    is_env_sensor_file_name,
+    read_zip_member_names,
+    sniff,
+)
+
+ENV_FILE_NAME = "UW_ENV_UW_ENV_2023_ENV-1001-42.zip"
+
+
+def make_zip(members, comment=b""):
+    buffer = io.BytesIO()
+
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+        archive.comment = comment
+
+    return buffer.getvalue()
+
+
+class RangeReader:
+    """Serve range reads from bytes and remember what was read."""
+
+    def __init__(self, data):
+        self.data = data
+        self.reads = []
+
+    def __call__(self, offset, length):
+        self.reads.append((offset, length))
+        end = offset + length
+        return self.data[offset:end]
+
+
+def test_read_zip_member_names():
+    data = make_zip([("study/a.dcm", b"a"), ("study/b.csv", b"b")])
+
+    names = read_zip_member_names(RangeReader(data), len(data))
+
+    assert names == ["study/a.dcm", "study/b.csv"]
+
+
+def test_read_zip_member_names_reads_only_the_tail():
+    data = make_zip([("study/a.dcm", b"x" * 200_000)])
+    reader = RangeReader(data)
+
+    assert read_zip_member_names(reader, len(data)) == ["study/a.dcm"]
+    assert reader.reads == [(len(data) - TAIL_BYTES, TAIL_BYTES)]
+
+
+def test_read_zip_member_names_after_a_long_comment():
+    # the directory is outside the tail that is read first
+    data = make_zip(
+        [(f"study/{index}.dcm", b"x" * 100) for index in range(200)],
+        comment=b"c" * 60_000,
+    )
+
+    reader = RangeReader(data)
+
+    names = read_zip_member_names(reader, len(data))
+
+    assert names == [f"study/{index}.dcm" for index in range(200)]
+    assert len(reader.reads) == 2
+
+
+def test_read_zip_member_names_zip64():
+    # more entries than the classic end of central directory record can hold
+    count = 0xFFFF + 10
+    data = make_zip((f"{index}.csv", b"") for index in range(count))
+
+    names = read_zip_member_names(RangeReader(data), len(data))
+
+    assert len(names) == count
+    assert names[-1] == f"{count - 1}.csv"
+
+
+def test_read_zip_member_names_not_a_zip():
+    data = b"not a zip archive" * 10
+
+    assert read_zip_member_names(RangeReader(data), len(data)) is None
+
+
+@pytest.mark.parametrize(
+    "members, content_type",
+    [
+        ([("study/a.dcm", b"a"), ("__MACOSX/study/._a.dcm", b"")], DICOM_ZIP),
+        ([("a.csv", b"x,y\n"), ("b.CSV", b"x,y\n")], CSV_ZIP),
+        ([("__MACOSX/._a.dcm", b""), ("notes.txt", b"")], ZIP),
+        ([], ZIP),
+    ],
+)
+def test_sniff_zip(members, content_type):
+    data = make_zip(members)
+
+    result = sniff("folder/file.zip", RangeReader(data), len(data))
+
+    assert result.content_type == content_type
+
+
+def test_sniff_loose_files():
+    dicom = b"\x00" * 128 + b"DICM" + b"\x00" * 100
+    csv = b"timestamp,value\n1,2\n"
+
+    assert sniff("a.dcm", RangeReader(dicom), len(dicom)).content_type == DICOM
+    assert sniff("a.csv", RangeReader(csv), len(csv)).content_type == CSV
+    assert sniff("a.bin", RangeReader(b"\x00\x01"), 2).content_type == UNKNOWN
+    assert sniff("a.bin", RangeReader(b""), 0).content_type == UNKNOWN
+
+
+def test_env_sensor_file_names():
+    assert is_env_sensor_file_name(ENV_FILE_NAME)
+    assert not is_env_sensor_file_name("ENV-readings.zip")
+    assert not is_env_sensor_file_name("UW_OCT_UW_OCT_2023_OCT-1001-42.zip")
+
+
+def test_csv_zip_is_a_mismatch_outside_sensor_names():
+    data = make_zip([("a.csv", b"x,y\n")])
+
+    sensor = sniff(f"EnvSensor/{ENV_FILE_NAME}", RangeReader(data), len(data))
+    renamed = sniff("EnvSensor/readings.zip", RangeReader(data), len(data))
+
+    assert sensor.content_type == renamed.content_type == CSV_ZIP
+    assert not sensor.mismatch
+    assert renamed.expected_type is None
+    assert renamed.mismatch
+
+
+def test_dicom_zip_under_a_sensor_name_is_a_mismatch():
+    data = make_zip([("study/a.dcm", b"a")])
+
+    result = sniff(ENV_FILE_NAME, RangeReader(data), len(data))
+
+    assert result.expected_type == CSV_ZIP
+    assert result.content_type == DICOM_ZIP
+    assert result.mismatch
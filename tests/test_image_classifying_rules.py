@@ -0,0 +1,155 @@
+"""Tests for whole-archive DICOM classification."""
+import io
+import zipfile
+
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian
+
+from utils.image_classifying_rules import (
+    DicomZipIndex,
+    classify_dicom_zip,
+    process_dicom_zip,
+)
+
+IMAGE = "1.2.840.10008.5.1.4.1.1.77.1.5.1"
+OCT = "1.2.840.10008.5.1.4.1.1.77.1.5.4"
+EN_FACE = "1.2.840.10008.5.1.4.1.1.77.1.5.7"
+
+
+def reference(sop_instance_uid):
+    item = Dataset()
+    item.ReferencedSOPInstanceUID = sop_instance_uid
+    return item
+
+
+def make_dicom(sop_class_uid, sop_instance_uid, **elements):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class_uid
+    meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    meta.ImplementationVersionName = "fo-dicom 4.0.8"
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.PatientID = "1001"
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.Rows = 1536
+    ds.Columns = 1536
+    ds.ImageLaterality = "R"
+    ds.ManufacturerModelName = "Spectralis"
+    ds.SoftwareVersions = "1"
+
+    for keyword, value in elements.items():
+        setattr(ds, keyword, value)
+
+    buffer = io.BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+def make_oct(sop_instance_uid, referenced_uid):
+    group = Dataset()
+    group.ReferencedImageSequence = Sequence([reference(referenced_uid)])
+
+    return make_dicom(
+        OCT,
+        sop_instance_uid,
+        NumberOfFrames=27,
+        SharedFunctionalGroupsSequence=Sequence([group]),
+    )
+
+
+@pytest.fixture
+def archive(tmp_path):
+    path = tmp_path / "study.zip"
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr("study/ir.1.1.dcm", make_dicom(IMAGE, "1.2.3.1"))
+        zip_ref.writestr("study/oct.dcm", make_oct("1.2.3.2", "1.2.3.1"))
+        zip_ref.writestr(
+            "study/enface.dcm",
+            make_dicom(
+                EN_FACE, "1.2.3.3", SourceImageSequence=Sequence([reference("1.2.3.1")])
+            ),
+        )
+        zip_ref.writestr("study/orphan.dcm", make_oct("1.2.3.4", "9.9.9"))
+        zip_ref.writestr("study/notes.txt", "not a DICOM file")
+        zip_ref.writestr("__MACOSX/study/._oct.dcm", "resource fork")
+        zip_ref.writestr("other/.hidden.dcm", "hidden")
+
+    return str(path)
+
+
+def by_member(manifest):
+    return {instance["member"]: instance for instance in manifest["instances"]}
+
+
+def test_index_counts_folders_and_skips_metadata(archive):
+    index = DicomZipIndex(archive)
+
+    assert sorted(index.dicom_members) == [
+        "study/enface.dcm",
+        "study/ir.1.1.dcm",
+        "study/oct.dcm",
+        "study/orphan.dcm",
+    ]
+    assert index.folder_counts["study"] == 5
+    assert index.number_of_files("study/oct.dcm") == 5
+
+
+def test_references_resolve_to_members(archive):
+    manifest = classify_dicom_zip(archive, max_workers=2)
+    instances = by_member(manifest)
+
+    assert manifest["number_of_dicom_files"] == 4
+
+    image = instances["study/ir.1.1.dcm"]
+    assert image["sopinstanceuid"] == "1.2.3.1"
+    assert "referenced_member" not in image
+
+    for member in ["study/oct.dcm", "study/enface.dcm"]:
+        assert instances[member]["referencedsopinstance"] == "1.2.3.1"
+        assert instances[member]["referenced_member"] == "study/ir.1.1.dcm"
+        assert instances[member]["referenced_protocol"] == image["protocol"]
+
+
+def test_missing_references_are_reported(archive):
+    manifest = classify_dicom_zip(archive)
+
+    assert manifest["unresolved_references"] == ["study/orphan.dcm"]
+    assert "referenced_member" not in by_member(manifest)["study/orphan.dcm"]
+
+
+def test_member_errors_become_records(tmp_path):
+    path = str(tmp_path / "broken.zip")
+
+    with zipfile.ZipFile(path, "w") as zip_ref:
+        zip_ref.writestr("study/ir.dcm", make_dicom(IMAGE, "1.2.3.1"))
+        zip_ref.writestr("study/broken.dcm", b"\x00" * 10)
+        zip_ref.writestr("study/oct.dcm", make_oct("1.2.3.2", "1.2.3.1"))
+
+    manifest = classify_dicom_zip(path)
+    instances = by_member(manifest)
+
+    assert set(instances["study/broken.dcm"]) == {"member", "error"}
+    assert instances["study/oct.dcm"]["referenced_member"] == "study/ir.dcm"
+    assert manifest["unresolved_references"] == []
+
+
+def test_archive_without_dicom_members(tmp_path):
+    path = str(tmp_path / "empty.zip")
+
+    with zipfile.ZipFile(path, "w") as zip_ref:
+        zip_ref.writestr("notes.txt", "no images")
+
+    assert classify_dicom_zip(path) is None
+
+
+def test_process_dicom_zip_whole_archive_mode(archive):
+    manifest = process_dicom_zip(archive, whole_archive=True)
+
+    assert manifest["zip_file"] == "study.zip"
+    assert len(manifest["instances"]) == 4
@@ -0,0 +1,113 @@
+"""Tests for the run instrumentation."""
+import json
+import threading
+
+import pytest
+
+from utils import instrumentation
+from utils.instrumentation import RunMetrics, StageStats
+
+
+def test_stage_stats_histogram_buckets():
+    stats = StageStats("parse")
+
+    for seconds in [0.05, 0.1, 0.3, 7, 1000]:
+        stats.record(seconds)
+    stats.record(0.2, failed=True)
+
+    result = stats.to_dict()
+    assert result["count"] == 6
+    assert result["errors"] == 1
+    assert result["max_seconds"] == 1000
+    assert result["histogram"]["le_0.1"] == 2
+    assert result["histogram"]["le_0.25"] == 1
+    assert result["histogram"]["le_0.5"] == 1
+    assert result["histogram"]["le_10"] == 1
+    assert result["histogram"]["le_inf"] == 1
+    assert sum(result["histogram"].values()) == 6
+
+
+def test_empty_stage_stats():
+    assert StageStats("parse").to_dict()["mean_seconds"] == 0
+
+
+def test_slowest_files_keep_the_top_n():
+    metrics = RunMetrics("test", "run", top_n=3)
+
+    for index, seconds in enumerate([0.5, 3, 0.1, 2, 5, 1]):
+        metrics.record_file(f"file-{index}", seconds)
+
+    assert metrics.slowest_files() == [
+        {"path": "file-4", "seconds": 5},
+        {"path": "file-1", "seconds": 3},
+        {"path": "file-3", "seconds": 2},
+    ]
+    assert metrics.files_processed == 6
+    assert metrics.summary()["stages"]["file"]["count"] == 6
+
+
+def test_span_records_failures():
+    metrics = RunMetrics("test", "run")
+
+    with metrics.span("download"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.span("download"):
+            raise ValueError("bad")
+
+    stage = metrics.summary()["stages"]["download"]
+    assert (stage["count"], stage["errors"]) == (2, 1)
+
+
+def test_span_without_metrics_is_a_no_op():
+    with instrumentation.span(None, "download"):
+        pass
+
+
+def test_summary_merges_counters_bytes_and_sections():
+    metrics = RunMetrics("test", "run-id")
+
+    metrics.add_bytes("download", 10)
+    metrics.add_bytes("download", 5)
+    metrics.increment("sniff.dicom")
+    metrics.increment("sniff.dicom", 2)
+    metrics.add_section("storage", {"concurrency_limit": 4})
+    metrics.add_section("storage", {"concurrency_limit": 8})
+
+    summary = json.loads(metrics.dumps())
+    assert summary["pipeline"] == "test"
+    assert summary["workflow_id"] == "run-id"
+    assert summary["bytes"] == {"download": 15}
+    assert summary["counters"] == {"sniff.dicom": 3}
+    assert summary["storage"] == {"concurrency_limit": 8}
+    assert "peak_memory_bytes" in summary
+
+
+def test_metrics_are_thread_safe():
+    metrics = RunMetrics("test", "run", top_n=5)
+
+    def worker(offset):
+        for index in range(500):
+            metrics.increment("events")
+            metrics.add_bytes("download", 2)
+            metrics.record_stage("parse", 0.01)
+            metrics.record_file(f"{offset}-{index}", index / 1000)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    summary = metrics.summary()
+    assert summary["counters"]["events"] == 4000
+    assert summary["bytes"]["download"] == 8000
+    assert summary["stages"]["parse"]["count"] == 4000
+    assert summary["files_processed"] == 4000
+    assert [entry["seconds"] for entry in summary["slowest_files"]] == [0.499] * 5
+
+
+def test_configure_exporter_needs_a_connection_string(monkeypatch):
+    monkeypatch.delenv("APPLICATIONINSIGHTS_CONNECTION_STRING", raising=False)
+
+    assert instrumentation.configure_exporter() is False
@@ -0,0 +1,118 @@
+"""Tests for stratified sampling of pipeline listings."""
+import pytest
+
+from utils.sampling import (
+    SampleReport,
+    folder_stratum,
+    protocols_of,
+    stratified_sample,
+)
+
+ROOT = "AI-READI/pooled-data"
+
+PATHS = [
+    f"{ROOT}/{device}/{site}/{index}.zip"
+    for device in ["Spectralis", "Cirrus"]
+    for site in ["UW", "UCSD", "UAB"]
+    for index in range(10)
+] + [f"{ROOT}/loose.zip"]
+
+
+def test_folder_stratum():
+    stratum_of = folder_stratum(ROOT + "/")
+
+    assert stratum_of(f"{ROOT}/Spectralis/UW/a/b.zip") == "Spectralis/UW"
+    assert stratum_of(f"{ROOT}/Spectralis/b.zip") == "Spectralis"
+    assert stratum_of(f"{ROOT}/b.zip") == "."
+
+
+def test_sample_is_capped_per_stratum():
+    sample, strata = stratified_sample(PATHS, 3, 0, folder_stratum(ROOT))
+
+    assert strata["Spectralis/UW"] == 10
+    assert strata["."] == 1
+    assert len(strata) == 7
+    assert len(sample) == 6 * 3 + 1
+    assert len(set(sample)) == len(sample)
+
+
+def test_sample_is_reproducible_and_order_independent():
+    stratum_of = folder_stratum(ROOT)
+
+    first, _ = stratified_sample(PATHS, 2, 42, stratum_of)
+    again, _ = stratified_sample(reversed(PATHS), 2, 42, stratum_of)
+    other, _ = stratified_sample(PATHS, 2, 43, stratum_of)
+
+    assert sorted(first) == sorted(again)
+    assert sorted(first) != sorted(other)
+
+
+def test_stratum_sample_does_not_depend_on_other_strata():
+    stratum_of = folder_stratum(ROOT)
+    uw = [path for path in PATHS if "/Spectralis/UW/" in path]
+
+    alone, _ = stratified_sample(uw, 2, 7, stratum_of)
+    together, _ = stratified_sample(PATHS, 2, 7, stratum_of)
+
+    assert set(alone) <= set(together)
+
+
+def test_sample_with_key():
+    files = [(path, 1, '"etag"') for path in PATHS]
+
+    sample, _ = stratified_sample(
+        files, 1, 0, folder_stratum(ROOT), key=lambda file: file[0]
+    )
+
+    assert all(isinstance(file, tuple) for file in sample)
+    assert len(sample) == 7
+
+
+def test_sample_report():
+    report = SampleReport(2, 5, {"Spectralis/UW": 10})
+
+    report.add("Spectralis/UW", protocols_of({"protocol": "spectralis_oct"}))
+    report.add(
+        "Spectralis/UW",
+        protocols_of({"instances": [{"protocol": "ir"}, {"error": "bad"}]}),
+    )
+
+    assert report.to_dict() == {
+        "per_stratum": 2,
+        "seed": 5,
+        "strata": {
+            "Spectralis/UW": {
+                "listed": 10,
+                "sampled": 2,
+                "protocols": {"spectralis_oct": 1, "ir": 1, "Error": 1},
+            }
+        },
+    }
+
+
+@pytest.mark.parametrize(
+    "params, expected",
+    [
+        ({}, (None, 0)),
+        ({"sample": "3", "seed": "9"}, (3, 9)),
+        ({"sample": ""}, (None, 0)),
+    ],
+)
+def test_sampling_params(params, expected):
+    func = pytest.importorskip("azure.functions")
+    from function_app import sampling_params
+
+    request = func.HttpRequest("GET", "/api/run", params=params, body=b"")
+
+    assert sampling_params(request) == expected
+
+
+@pytest.mark.parametrize("sample", ["0", "-2", "three"])
+def test_sampling_params_rejects_invalid_samples(sample):
+    func = pytest.importorskip("azure.functions")
+    from function_app import sampling_params
+
+    request = func.HttpRequest("GET", "/api/run", params={"sample": sample}, body=b"")
+
+    with pytest.raises(ValueError):
+        sampling_params(request)
@@ -0,0 +1,227 @@
+"""Tests for the throttle-aware storage wrapper."""
+import threading
+import time
+
+import pytest
+from azure.core.exceptions import ServiceResponseError
+
+from utils.instrumentation import RunMetrics
+from utils.storage import (
+    AdaptiveConcurrency,
+    LocalFaultyBackend,
+    RateBudget,
+    Storage,
+    ThrottledError,
+    default_budgets,
+    is_throttle_error,
+)
+
+
+@pytest.fixture
+def root(tmp_path):
+    folder = tmp_path / "container" / "data"
+    folder.mkdir(parents=True)
+
+    for index in range(4):
+        (folder / f"{index}.bin").write_bytes(bytes([index]) * 10)
+
+    return tmp_path / "container"
+
+
+def make_storage(backend, **kwargs):
+    kwargs.setdefault("base_delay", 0.001)
+    kwargs.setdefault("max_delay", 0.01)
+    return Storage(backend, **kwargs)
+
+
+def test_concurrency_halves_once_per_throttling_epoch():
+    concurrency = AdaptiveConcurrency(initial=8)
+
+    epochs = [concurrency.acquire() for _ in range(4)]
+    for epoch in epochs:
+        concurrency.release(epoch, throttled=True)
+
+    assert concurrency.limit == 4
+    assert concurrency.in_flight == 0
+
+
+def test_concurrency_grows_by_one_per_window_of_successes():
+    concurrency = AdaptiveConcurrency(initial=2, maximum=4)
+
+    for _ in range(2):
+        concurrency.release(concurrency.acquire())
+    assert concurrency.limit == 3
+
+    for _ in range(20):
+        concurrency.release(concurrency.acquire())
+    assert concurrency.limit == 4
+
+
+def test_concurrency_never_drops_below_minimum():
+    concurrency = AdaptiveConcurrency(initial=2, minimum=1)
+
+    for _ in range(5):
+        concurrency.release(concurrency.acquire(), throttled=True)
+
+    assert concurrency.limit == 1
+
+
+def test_storage_backs_off_an_overloaded_backend(root):
+    backend = LocalFaultyBackend(str(root), capacity=2, latency=0.005)
+    storage = make_storage(backend, concurrency=AdaptiveConcurrency(initial=8))
+    errors = []
+
+    def worker():
+        try:
+            for index in range(4):
+                assert storage.download(f"data/{index}.bin") == bytes([index]) * 10
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert storage.concurrency.limit < 8
+
+    report = storage.report()["operations"]["download"]
+    assert report["calls"] == 32
+    assert report["throttled"] > 0
+    assert report["failed"] == 0
+
+
+def test_storage_grows_concurrency_while_calls_succeed(root):
+    storage = make_storage(
+        LocalFaultyBackend(str(root)),
+        concurrency=AdaptiveConcurrency(initial=1, maximum=3),
+    )
+
+    for _ in range(10):
+        storage.download("data/0.bin")
+
+    assert storage.concurrency.limit == 3
+
+
+def test_storage_raises_once_retries_are_exhausted(root):
+    storage = make_storage(
+        LocalFaultyBackend(str(root), throttle_rate=1.0), max_retries=2
+    )
+
+    with pytest.raises(ThrottledError):
+        storage.download("data/0.bin")
+
+    report = storage.report()["operations"]["download"]
+    assert report["retries"] == 2
+    assert report["throttled"] == 3
+    assert report["failed"] == 1
+
+
+def test_storage_does_not_retry_other_errors(root):
+    storage = make_storage(LocalFaultyBackend(str(root)))
+
+    with pytest.raises(FileNotFoundError):
+        storage.download("data/missing.bin")
+
+    report = storage.report()["operations"]["download"]
+    assert report["retries"] == 0
+    assert report["failed"] == 1
+
+
+def test_storage_counts_bytes_and_range_reads(root):
+    storage = make_storage(LocalFaultyBackend(str(root)))
+
+    assert storage.download_range("data/2.bin", 4, 3) == bytes([2]) * 3
+    assert storage.download("data/3.bin") == bytes([3]) * 10
+
+    operations = storage.report()["operations"]
+    assert operations["download_range"]["bytes"] == 3
+    assert operations["download"]["bytes"] == 10
+
+
+def test_iter_files_lists_every_file(root):
+    storage = make_storage(LocalFaultyBackend(str(root)))
+
+    names = [name for name, _, _ in storage.iter_files("data")]
+
+    assert names == [f"data/{index}.bin" for index in range(4)]
+
+
+def test_iter_files_times_every_page(root):
+    class PagedBackend(LocalFaultyBackend):
+        def list_page(self, path, continuation_token=None, page_size=3):
+            return super().list_page(path, continuation_token, page_size)
+
+    metrics = RunMetrics("test", "run")
+    storage = make_storage(PagedBackend(str(root)), metrics=metrics)
+
+    assert len(list(storage.iter_files("data"))) == 4
+    assert metrics.summary()["stages"]["list"]["count"] == 2
+
+
+def test_rate_budget_limits_calls_per_second():
+    budget = RateBudget(rate=100, burst=1)
+
+    start = time.monotonic()
+    for _ in range(6):
+        budget.acquire()
+
+    assert time.monotonic() - start >= 0.04
+
+
+def test_storage_retries_transient_connection_errors(root):
+    class ResetOnceBackend(LocalFaultyBackend):
+        resets = 0
+
+        def download(self, path):
+            if not self.resets:
+                self.resets += 1
+                raise ServiceResponseError("Connection reset")
+            return super().download(path)
+
+    concurrency = AdaptiveConcurrency(initial=4)
+    storage = make_storage(ResetOnceBackend(str(root)), concurrency=concurrency)
+
+    assert storage.download("data/1.bin") == bytes([1]) * 10
+    assert concurrency.limit == 4
+
+    report = storage.report()["operations"]["download"]
+    assert report["transient"] == 1
+    assert report["retries"] == 1
+    assert report["throttled"] == 0
+
+
+@pytest.mark.parametrize(
+    "status_code, error_code, throttled",
+    [
+        (503, "ServerBusy", True),
+        (429, None, True),
+        (500, "OperationTimedOut", True),
+        (500, "InternalError", False),
+        (404, "BlobNotFound", False),
+    ],
+)
+def test_is_throttle_error(status_code, error_code, throttled):
+    assert is_throttle_error(ThrottledError(status_code, error_code)) is throttled
+
+
+def test_storage_spends_the_operation_budget(root):
+    storage = make_storage(
+        LocalFaultyBackend(str(root)), budgets={"download": RateBudget(100, burst=1)}
+    )
+
+    start = time.monotonic()
+    for _ in range(6):
+        storage.download("data/0.bin")
+        storage.download_range("data/0.bin", 0, 1)
+
+    assert time.monotonic() - start >= 0.04
+
+
+def test_default_budgets_cover_every_pipeline_operation():
+    budgets = default_budgets()
+
+    assert set(budgets) == {"list", "download_range", "download", "upload"}
+    assert budgets["list"] is not default_budgets()["list"]
@@ -0,0 +1,145 @@
+"""Tests for the streaming stage framework."""
+import json
+import threading
+
+import pytest
+
+from utils import streaming
+from utils.instrumentation import RunMetrics
+from utils.streaming import JsonArrayWriter, Stage, StreamingPipeline
+
+
+@pytest.fixture(autouse=True)
+def fast_poll(monkeypatch):
+    monkeypatch.setattr(streaming, "POLL_SECONDS", 0.01)
+
+
+def run(source, stages, **kwargs):
+    results = []
+    StreamingPipeline(source, stages, results.append, **kwargs).run()
+    return results
+
+
+def double(item):
+    yield item * 2
+
+
+def test_items_pass_through_every_stage():
+    assert run(range(5), [Stage("double", double)]) == [0, 2, 4, 6, 8]
+
+
+def test_without_stages_the_source_goes_to_the_sink():
+    assert run(range(3), []) == [0, 1, 2]
+
+
+def test_stages_drop_and_expand_items():
+    def evens(item):
+        if item % 2 == 0:
+            yield item
+
+    def twice(item):
+        yield item
+        yield item
+
+    results = run(range(6), [Stage("evens", evens), Stage("twice", twice)])
+
+    assert results == [0, 0, 2, 2, 4, 4]
+
+
+def test_several_workers_per_stage_finish_every_item():
+    # each worker of a stage passes DONE on to every worker of the next one
+    stages = [
+        Stage("first", double, workers=4),
+        Stage("second", double, workers=3),
+        Stage("third", double, workers=5),
+    ]
+
+    results = run(range(200), stages, queue_size=2)
+
+    assert sorted(results) == [item * 8 for item in range(200)]
+
+
+def test_stage_error_is_raised_and_stops_the_pipeline():
+    def fail_on_three(item):
+        if item == 3:
+            raise ValueError("bad item")
+        yield item
+
+    with pytest.raises(ValueError, match="bad item"):
+        run(range(1000), [Stage("check", fail_on_three, workers=3)], queue_size=2)
+
+
+def test_source_error_is_raised():
+    def source():
+        yield 1
+        raise OSError("listing failed")
+
+    with pytest.raises(OSError, match="listing failed"):
+        run(source(), [Stage("double", double, workers=2)])
+
+
+def test_sink_error_is_raised():
+    def sink(item):
+        if item == 4:
+            raise RuntimeError("sink failed")
+
+    pipeline = StreamingPipeline(range(100), [Stage("double", double)], sink)
+
+    with pytest.raises(RuntimeError, match="sink failed"):
+        pipeline.run()
+
+
+def test_items_left_behind_are_discarded():
+    produced = []
+    consumed = []
+    discarded = []
+    lock = threading.Lock()
+
+    def produce(item):
+        with lock:
+            produced.append(item)
+        yield ("output", item)
+
+    def sink(output):
+        consumed.append(output[1])
+        if len(consumed) == 3:
+            raise RuntimeError("sink failed")
+
+    pipeline = StreamingPipeline(
+        range(100),
+        [Stage("produce", produce, workers=2)],
+        sink,
+        queue_size=4,
+        discard=discarded.append,
+    )
+
+    with pytest.raises(RuntimeError):
+        pipeline.run()
+
+    outputs = [item[1] for item in discarded if isinstance(item, tuple)]
+    inputs = [item for item in discarded if not isinstance(item, tuple)]
+
+    # every output is either consumed or discarded, inputs still queued
+    # never reached the stage
+    assert inputs
+    assert sorted(consumed + outputs) == sorted(produced)
+    assert not set(inputs) & set(produced)
+
+
+def test_stage_time_is_recorded():
+    metrics = RunMetrics("test", "run")
+
+    run(range(4), [Stage("double", double, workers=2)], metrics=metrics)
+
+    assert metrics.summary()["stages"]["double"]["count"] == 4
+
+
+@pytest.mark.parametrize("records", [[], [{"a": 1}], [{"a": [1, 2]}, "text", 3]])
+def test_json_array_writer_matches_json_dumps(tmp_path, records):
+    path = tmp_path / "log.json"
+
+    with JsonArrayWriter(str(path)) as writer:
+        for record in records:
+            writer.write(record)
+
+    assert path.read_text(encoding="utf-8") == json.dumps(records, indent=4)
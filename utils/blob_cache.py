@@ -0,0 +1,252 @@
+"""Size-bounded on-disk cache of downloaded blobs.
+
+Entries are keyed by blob path and etag, so a blob that changed in storage
+is downloaded again. The least recently used entries are evicted once the
+cache grows past its byte budget. Entries are guarded by file locks, which
+makes the cache safe to share between threads and between worker processes
+on the same instance; entries in use are never evicted.
+"""
+import contextlib
+import hashlib
+import os
+import posixpath
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None  # type: ignore
+
+EVICTION_LOCK = "eviction.lock"
+
+
+@contextlib.contextmanager
+def file_lock(lock_path, shared=False, blocking=True):
+    """Hold a flock on `lock_path`, yielding False if it was not acquired.
+
+    Lock files are unlinked by `BlobCache.evict` while locked, so a lock that
+    was acquired on a file no longer found at `lock_path` is taken again.
+    """
+    while True:
+        with open(lock_path, "a+b") as lock_file:
+            if fcntl is None:
+                yield True
+                return
+
+            operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                operation |= fcntl.LOCK_NB
+
+            try:
+                fcntl.flock(lock_file, operation)
+            except BlockingIOError:
+                yield False
+                return
+
+            try:
+                if not _is_linked(lock_file, lock_path):
+                    continue
+
+                yield True
+                return
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _is_linked(lock_file, lock_path):
+    """Return True if `lock_file` is still the file at `lock_path`."""
+    try:
+        return os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _unlink(path):
+    with contextlib.suppress(OSError):
+        os.unlink(path)
+
+
+class BlobCache:
+    def __init__(self, root, max_bytes, metrics=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_hit = 0
+        self.bytes_evicted = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, path, etag):
+        return hashlib.sha256(f"{path}\n{etag}".encode("utf-8")).hexdigest()
+
+    @contextlib.contextmanager
+    def open(self, path, etag, fetch):
+        """Yield a local copy of `path`, calling `fetch()` for its bytes on a miss.
+
+        The entry keeps the blob's file name and cannot be evicted until the
+        block exits.
+        """
+        key = self.key(path, etag)
+        entry_folder = os.path.join(self.root, key)
+        entry_path = os.path.join(entry_folder, posixpath.basename(path))
+        lock_path = os.path.join(self.root, f"{key}.lock")
+
+        with file_lock(lock_path):
+            inserted = not os.path.exists(entry_path)
+
+            if inserted:
+                self._write(entry_folder, entry_path, fetch())
+            else:
+                # the modification time orders entries for eviction
+                os.utime(entry_path)
+
+        with file_lock(lock_path, shared=True):
+            # evicted between the two locks by another process
+            if not os.path.exists(entry_path):
+                self._write(entry_folder, entry_path, fetch())
+                refetched = True
+            else:
+                refetched = False
+
+            # each lookup counts once, as a hit only if nothing was fetched
+            if inserted or refetched:
+                self._count_miss()
+            else:
+                self._count_hit(os.path.getsize(entry_path))
+
+            if inserted:
+                self.evict()
+
+            yield entry_path
+
+    def _write(self, entry_folder, entry_path, data):
+        os.makedirs(entry_folder, exist_ok=True)
+
+        temp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+
+        os.replace(temp_path, entry_path)
+
+    def entries(self):
+        """Return `(last_used, size, key)` for every entry in the cache."""
+        entries = []
+
+        for key in os.listdir(self.root):
+            entry_folder = os.path.join(self.root, key)
+            if not os.path.isdir(entry_folder):
+                continue
+
+            # entries may be written or removed by other workers meanwhile
+            try:
+                for name in os.listdir(entry_folder):
+                    if name.endswith(".tmp"):
+                        continue
+                    stat = os.stat(os.path.join(entry_folder, name))
+                    entries.append((stat.st_mtime, stat.st_size, key))
+            except FileNotFoundError:
+                continue
+
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits its budget."""
+        with file_lock(os.path.join(self.root, EVICTION_LOCK)):
+            self.sweep()
+
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+
+            for _, size, key in entries:
+                if total <= self.max_bytes:
+                    break
+
+                lock_path = os.path.join(self.root, f"{key}.lock")
+
+                # entries in use hold a shared lock, skip them
+                with file_lock(lock_path, blocking=False) as acquired:
+                    if not acquired:
+                        continue
+
+                    shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+                    _unlink(lock_path)
+
+                total -= size
+
+                with self._lock:
+                    self.evictions += 1
+                    self.bytes_evicted += size
+
+    def sweep(self):
+        """Remove temp files left by failed writes and locks without an entry.
+
+        Writers hold the entry's lock, so a temp file found while the lock is
+        free belongs to a write that will never finish.
+        """
+        for name in os.listdir(self.root):
+            if name == EVICTION_LOCK:
+                continue
+
+            key = name.removesuffix(".lock")
+            entry_folder = os.path.join(self.root, key)
+            lock_path = os.path.join(self.root, f"{key}.lock")
+
+            if name.endswith(".lock"):
+                if os.path.isdir(entry_folder):
+                    continue
+            elif not os.path.isdir(entry_folder):
+                continue
+
+            with file_lock(lock_path, blocking=False) as acquired:
+                if not acquired:
+                    continue
+
+                try:
+                    names = os.listdir(entry_folder)
+                except FileNotFoundError:
+                    names = []
+
+                for temp_name in names:
+                    if temp_name.endswith(".tmp"):
+                        _unlink(os.path.join(entry_folder, temp_name))
+
+                # nothing but failed writes, or the entry was evicted
+                if all(n.endswith(".tmp") for n in names):
+                    with contextlib.suppress(OSError):
+                        os.rmdir(entry_folder)
+                    _unlink(lock_path)
+
+    def _count_hit(self, size):
+        with self._lock:
+            self.hits += 1
+            self.bytes_hit += size
+
+        if self.metrics is not None:
+            self.metrics.increment("blob_cache.hit")
+
+    def _count_miss(self):
+        with self._lock:
+            self.misses += 1
+
+        if self.metrics is not None:
+            self.metrics.increment("blob_cache.miss")
+
+    def report(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {
+                "root": self.root,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+                "bytes_hit": self.bytes_hit,
+                "evictions": self.evictions,
+                "bytes_evicted": self.bytes_evicted,
+            }
@@ -0,0 +1,204 @@
+"""Identify pipeline inputs from their content instead of their names.
+
+Only the first few KB of a file, and for zip archives the central directory
+at the end, are read through range reads, so the right handler can be picked
+before anything is downloaded in full.
+"""
+import posixpath
+import re
+import struct
+
+from utils.image_classifying_rules import is_dicom_member
+
+HEAD_BYTES = 4096
+
+# The end of central directory record is 22 bytes plus a comment of up to 64KB
+TAIL_BYTES = 22 + 65535
+
+ZIP_LOCAL_HEADER = b"PK\x03\x04"
+ZIP_END_OF_CENTRAL_DIRECTORY = b"PK\x05\x06"
+ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR = b"PK\x06\x07"
+ZIP_CENTRAL_DIRECTORY_HEADER = b"PK\x01\x02"
+
+DICOM_PREAMBLE_OFFSET = 128
+DICOM_MAGIC = b"DICM"
+
+DICOM_DEVICES = [
+    "Optomed",
+    "Eidon",
+    "Maestro",
+    "Triton",
+    "FLIO",
+    "Cirrus",
+    "Spectralis",
+]
+
+# Sensor archives are named SITE_ENV_SITE_ENV_DATES_PREFIX-PATIENT-SENSOR.zip
+ENV_SENSOR_FILE_NAME = re.compile(r"^(?:[^_/]+_){5}[^_/-]+-[^_/-]+-[^_/.-]+\.zip$")
+
+# Content types
+DICOM_ZIP = "dicom_zip"
+CSV_ZIP = "csv_zip"
+ZIP = "zip"
+DICOM = "dicom"
+CSV = "csv"
+UNKNOWN = "unknown"
+
+
+class SniffResult:
+    def __init__(self, content_type, expected_type, members=None):
+        self.content_type = content_type
+        self.expected_type = expected_type
+        self.members = members or []
+
+    @property
+    def mismatch(self):
+        """True when the file name suggests a different content type.
+
+        CSV archives are only handled under a sensor file name, so one found
+        under any other name is a mismatch too.
+        """
+        if self.content_type == CSV_ZIP:
+            return self.expected_type != CSV_ZIP
+
+        return (
+            self.expected_type is not None and self.expected_type != self.content_type
+        )
+
+    def to_dict(self):
+        return {
+            "content_type": self.content_type,
+            "expected_type": self.expected_type,
+            "mismatch": self.mismatch,
+            "members": len(self.members),
+        }
+
+
+def is_env_sensor_file_name(file_name):
+    """Return True if `file_name` follows the sensor archive naming scheme."""
+    return "ENV" in file_name and ENV_SENSOR_FILE_NAME.match(file_name) is not None
+
+
+def expected_type(path):
+    """Return the content type the file name suggests, or None."""
+    file_name = posixpath.basename(path)
+
+    if file_name.endswith(".zip"):
+        if is_env_sensor_file_name(file_name):
+            return CSV_ZIP
+        if any(word in path for word in DICOM_DEVICES):
+            return DICOM_ZIP
+        return None
+
+    if file_name.endswith(".dcm"):
+        return DICOM
+
+    if file_name.endswith(".csv"):
+        return CSV
+
+    return None
+
+
+def is_dicom_header(head):
+    return head.startswith(DICOM_MAGIC, DICOM_PREAMBLE_OFFSET)
+
+
+def is_csv_header(head):
+    """Return True if the first line looks like a delimited header row."""
+    if b"\x00" in head:
+        return False
+
+    # the head may end in the middle of a multi-byte character
+    text = head.decode("utf-8-sig", errors="ignore")
+    first_line = text.splitlines()[0] if text else ""
+    return first_line.isprintable() and ("," in first_line or ";" in first_line)
+
+
+def read_zip_member_names(read_range, size, tail=None):
+    """Return member names from the central directory of a zip archive.
+
+    `read_range(offset, length)` returns the bytes of the given range.
+    `tail` may hold the last bytes of the file if they were already read.
+    """
+    tail_length = min(size, TAIL_BYTES)
+    if tail is None or len(tail) < tail_length:
+        tail = read_range(size - tail_length, tail_length)
+    tail_offset = size - len(tail)
+
+    eocd = tail.rfind(ZIP_END_OF_CENTRAL_DIRECTORY)
+    if eocd < 0:
+        return None
+
+    entries, directory_size, directory_offset = struct.unpack_from(
+        "<10xHII", tail, eocd
+    )
+
+    if 0xFFFFFFFF in (directory_size, directory_offset) or entries == 0xFFFF:
+        locator = tail.rfind(ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR, 0, eocd)
+        if locator < 0:
+            return None
+
+        (zip64_offset,) = struct.unpack_from("<Q", tail, locator + 8)
+        record = read_range(zip64_offset, 56)
+        directory_size, directory_offset = struct.unpack("<QQ", record[40:56])
+
+    if directory_offset >= tail_offset:
+        start = directory_offset - tail_offset
+        end = start + directory_size
+        directory = tail[start:end]
+    else:
+        directory = read_range(directory_offset, directory_size)
+
+    names = []
+    position = 0
+
+    while directory.startswith(ZIP_CENTRAL_DIRECTORY_HEADER, position):
+        name_length, extra_length, comment_length = struct.unpack_from(
+            "<HHH", directory, position + 28
+        )
+        name_start = position + 46
+        name_end = name_start + name_length
+        names.append(directory[name_start:name_end].decode("utf-8", errors="replace"))
+        position = name_end + extra_length + comment_length
+
+    return names
+
+
+def sniff(path, read_range, size):
+    """Identify the content type of `path` from its first bytes.
+
+    `read_range(offset, length)` returns the bytes of the given range of the
+    file and `size` is its total size in bytes.
+    """
+    head = read_range(0, min(size, HEAD_BYTES)) if size else b""
+
+    # an empty archive is only an end of central directory record
+    if head[:4] in (ZIP_LOCAL_HEADER, ZIP_END_OF_CENTRAL_DIRECTORY):
+        tail = head if size <= HEAD_BYTES else None
+        members = read_zip_member_names(read_range, size, tail) or []
+
+        # skip folders, __MACOSX and hidden files
+        files = [
+            name
+            for name in members
+            if not name.endswith("/")
+            and "/__" not in "/" + name
+            and "/." not in "/" + name
+        ]
+
+        if any(is_dicom_member(name) for name in files):
+            content_type = DICOM_ZIP
+        elif files and all(name.lower().endswith(".csv") for name in files):
+            content_type = CSV_ZIP
+        else:
+            content_type = ZIP
+
+        return SniffResult(content_type, expected_type(path), members)
+
+    if is_dicom_header(head):
+        return SniffResult(DICOM, expected_type(path))
+
+    if head and is_csv_header(head):
+        return SniffResult(CSV, expected_type(path))
+
+    return SniffResult(UNKNOWN, expected_type(path))
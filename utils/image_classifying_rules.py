@@ -1,8 +1,17 @@
 import os
+import posixpath
 import pydicom
 import tempfile
 import shutil
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.instrumentation import span
+
+# Threads used to read the members of one archive. Only decompression releases
+# the GIL, header parsing runs one member at a time.
+ARCHIVE_WORKERS = 2
 
 
 class ClassifyingRule:
@@ -238,20 +247,28 @@ def extract_dicom_entry(file):
     if not os.path.exists(file):
         raise FileNotFoundError(f"File {file} not found.")
 
-    dicom = pydicom.dcmread(file).to_json_dict()
     ds = pydicom.dcmread(file)
 
-    filename = os.path.basename(file)
-    patientid = dicom["00100020"]["Value"][0]
-    sopclassuid = dicom["00080016"]["Value"][0]
-    sopinstanceuid = dicom["00080018"]["Value"][0]
-
     folder_path = os.path.dirname(file)
     folder_files = os.listdir(folder_path)
     filecount = len(
         [f for f in folder_files if os.path.isfile(os.path.join(folder_path, f))]
     )
 
+    return dicom_entry_from_dataset(ds, os.path.basename(file), filecount)
+
+
+def dicom_entry_from_dataset(ds, filename, filecount):
+    """Build a DicomEntry from an already parsed dataset.
+
+    `filecount` is the number of files in the folder the dataset came from.
+    """
+    dicom = ds.to_json_dict()
+
+    patientid = dicom["00100020"]["Value"][0]
+    sopclassuid = dicom["00080016"]["Value"][0]
+    sopinstanceuid = dicom["00080018"]["Value"][0]
+
     if sopclassuid == "1.2.840.10008.5.1.4.1.1.77.1.5.1":
         rows = dicom["00280010"]["Value"][0]
         columns = dicom["00280011"]["Value"][0]
@@ -377,6 +394,10 @@ def extract_dicom_entry(file):
 
 def find_rule(file):
     dicomentry = extract_dicom_entry(file)
+    return find_rule_for_entry(dicomentry)
+
+
+def find_rule_for_entry(dicomentry):
     matching_rules = [rule for rule in rules if rule.apply(dicomentry)]
     if matching_rules:
         for rule in matching_rules:
@@ -417,7 +438,7 @@ def extract_dicom_summary(file):
     referencedsopinstance = dicomentry.referencedsopinstance
     softwareversion = dicomentry.softwareversion
     numberoffiles = dicomentry.numberoffiles
-    protocol = find_rule(file)
+    protocol = find_rule_for_entry(dicomentry)
 
     output = DicomSummary(domain, patientid, laterality, protocol)
     # output = DicomSummaryDetail(domain, modality, patientid, laterality, description,sopinstanceuid,referencedsopinstance)
@@ -447,11 +468,19 @@ def list_files_recursive(directory):
     return all_files
 
 
-def process_dicom_zip(zip_file_path):
+def process_dicom_zip(
+    zip_file_path, metrics=None, whole_archive=False, max_workers=ARCHIVE_WORKERS
+):
+    if whole_archive:
+        return classify_dicom_zip(
+            zip_file_path, metrics=metrics, max_workers=max_workers
+        )
+
     try:
         with tempfile.TemporaryDirectory() as temp_dir:
-            with zipfile.ZipFile(zip_file_path, "r") as zip_ref:
-                zip_ref.extractall(temp_dir)
+            with span(metrics, "extract_zip"):
+                with zipfile.ZipFile(zip_file_path, "r") as zip_ref:
+                    zip_ref.extractall(temp_dir)
             extracted_files = list_files_recursive(temp_dir)
 
             dicom_files = [
@@ -460,14 +489,16 @@ def process_dicom_zip(zip_file_path):
 
             if len(dicom_files) == 1:
                 dicom_file_path = os.path.join(temp_dir, dicom_files[0])
-                dicom = get_dicom_summary(dicom_file_path)
+                with span(metrics, "parse_dicom"):
+                    dicom = get_dicom_summary(dicom_file_path)
                 return dicom
 
             elif len(dicom_files) > 1:
                 for dicom_file in dicom_files:
                     if dicom_file.endswith(".1.1.dcm") and "/." not in dicom_file:
                         dicom_file_path = os.path.join(temp_dir, dicom_file)
-                        dicom = get_dicom_summary(dicom_file_path)
+                        with span(metrics, "parse_dicom"):
+                            dicom = get_dicom_summary(dicom_file_path)
                         return dicom
             else:
                 print("Error: no DICOM file present in the zip archive.")
@@ -479,6 +510,130 @@ def process_dicom_zip(zip_file_path):
     return None
 
 
+def is_dicom_member(member_name):
+    """Return True for DICOM members, skipping __MACOSX and hidden files."""
+    path = "/" + member_name
+    return member_name.endswith(".dcm") and "/__" not in path and "/." not in path
+
+
+class DicomZipIndex:
+    """Index of a DICOM archive built once from its central directory.
+
+    Holds the number of files per folder (used for `numberoffiles`) and, once
+    the members have been classified, a SOP instance UID to member map.
+    """
+
+    def __init__(self, zip_file_path):
+        self.zip_file_path = zip_file_path
+        self.folder_counts = {}
+        self.dicom_members = []
+        self.sop_instances = {}
+
+        with zipfile.ZipFile(zip_file_path, "r") as zip_ref:
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+
+                folder = posixpath.dirname(info.filename)
+                self.folder_counts[folder] = self.folder_counts.get(folder, 0) + 1
+
+                if is_dicom_member(info.filename):
+                    self.dicom_members.append(info.filename)
+
+    def number_of_files(self, member_name):
+        return self.folder_counts.get(posixpath.dirname(member_name), 0)
+
+
+def classify_dicom_member(zip_ref, index, member_name):
+    """Classify one archive member from its headers, without pixel data."""
+    with zip_ref.open(member_name) as member:
+        ds = pydicom.dcmread(member, stop_before_pixels=True)
+
+    entry = dicom_entry_from_dataset(
+        ds, posixpath.basename(member_name), index.number_of_files(member_name)
+    )
+
+    return {
+        "member": member_name,
+        "sopinstanceuid": str(ds.get("SOPInstanceUID", "N/A")),
+        "sopclassuid": entry.sopclassuid,
+        "patientid": entry.patientid,
+        "laterality": entry.laterality,
+        "device": entry.device,
+        "protocol": find_rule_for_entry(entry),
+        "referencedsopinstance": entry.referencedsopinstance,
+    }
+
+
+def classify_dicom_zip(zip_file_path, metrics=None, max_workers=ARCHIVE_WORKERS):
+    """Classify every DICOM member of an archive and link their references.
+
+    The archive is indexed once and members are read straight from the zip,
+    so nothing is extracted to disk. The `max_workers` threads only overlap
+    the decompression of members; header parsing holds the GIL and runs one
+    member at a time.
+
+    Returns a manifest with one record per member in which
+    `referencedsopinstance` is resolved to the referenced member and its
+    protocol (e.g. OCT to its reference IR image, segmentation to its volume).
+    """
+    with span(metrics, "index_zip"):
+        index = DicomZipIndex(zip_file_path)
+
+    if not index.dicom_members:
+        print("Error: no DICOM file present in the zip archive.")
+        return None
+
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def classify(member_name):
+        # ZipFile handles are not shared between threads
+        if not hasattr(local, "zip_ref"):
+            local.zip_ref = zipfile.ZipFile(zip_file_path, "r")
+            with handles_lock:
+                handles.append(local.zip_ref)
+
+        try:
+            with span(metrics, "parse_dicom"):
+                return classify_dicom_member(local.zip_ref, index, member_name)
+        except Exception as e:
+            return {"member": member_name, "error": str(e)}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            instances = list(executor.map(classify, index.dicom_members))
+    finally:
+        for handle in handles:
+            handle.close()
+
+    for instance in instances:
+        if "error" not in instance:
+            index.sop_instances[instance["sopinstanceuid"]] = instance
+
+    unresolved = []
+
+    for instance in instances:
+        reference = instance.get("referencedsopinstance", "N/A")
+        referenced = index.sop_instances.get(reference)
+
+        if referenced is not None:
+            instance["referenced_member"] = referenced["member"]
+            instance["referenced_protocol"] = referenced["protocol"]
+        elif reference != "N/A" and "error" not in instance:
+            unresolved.append(instance["member"])
+
+    return {
+        "domain": "DICOM",
+        "zip_file": os.path.basename(zip_file_path),
+        "number_of_dicom_files": len(index.dicom_members),
+        "folders": index.folder_counts,
+        "instances": instances,
+        "unresolved_references": unresolved,
+    }
+
+
 def extract_env_info(file_path):
     path_parts = file_path.split("/")
     filename = path_parts[-1]
@@ -0,0 +1,298 @@
+"""Run instrumentation for the stage one pipelines.
+
+Collects per-stage spans, byte counters, per-file latency histograms, peak
+memory and the slowest files of a run. The summary is written next to the run
+log and exported as custom metrics to Application Insights when the
+OpenTelemetry exporter is available.
+"""
+import contextlib
+import heapq
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None  # type: ignore
+
+try:
+    from opentelemetry import metrics as otel_metrics
+except ImportError:
+    otel_metrics = None  # type: ignore
+
+# Upper bounds (in seconds) of the per-file latency histogram buckets
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf")]
+
+METER_NAME = "fairhub-pipeline"
+
+
+def configure_exporter():
+    """Route OpenTelemetry metrics to Application Insights if configured.
+
+    The Functions host sets APPLICATIONINSIGHTS_CONNECTION_STRING when
+    Application Insights is enabled for the app (see host.json). The host
+    already forwards worker logs, so only metrics are exported from here.
+    """
+    if not os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING"):
+        return False
+
+    try:
+        from azure.monitor.opentelemetry import configure_azure_monitor
+    except ImportError:
+        logging.warning("azure-monitor-opentelemetry not installed, metrics disabled")
+        return False
+
+    configure_azure_monitor(disable_logging=True, disable_tracing=True)
+    return True
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS mark so it only covers what follows.
+
+    Linux only; returns False where the mark cannot be reset. Runs that
+    overlap in the same worker process reset each other's mark.
+    """
+    try:
+        with open("/proc/self/clear_refs", mode="w", encoding="ascii") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_bytes():
+    """Return the peak resident set size since the last `reset_peak_rss`."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def process_peak_rss_bytes():
+    """Return the peak resident set size over the life of this process."""
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageStats:
+    """Aggregated timings of one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def record(self, seconds, failed=False):
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+        if failed:
+            self.errors += 1
+
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_seconds": round(self.total_seconds, 3),
+            "mean_seconds": round(self.total_seconds / self.count, 3)
+            if self.count
+            else 0,
+            "max_seconds": round(self.max_seconds, 3),
+            "histogram": {
+                f"le_{bound}": count
+                for bound, count in zip(LATENCY_BUCKETS, self.buckets)
+            },
+        }
+
+
+class RunMetrics:
+    """Collects instrumentation for a single pipeline run.
+
+    Safe to share between worker threads.
+    """
+
+    def __init__(self, pipeline_name, workflow_id, top_n=20):
+        self.pipeline_name = pipeline_name
+        self.workflow_id = str(workflow_id)
+        self.top_n = top_n
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.bytes = {}
+        self.counters = {}
+        self.files_processed = 0
+        self.sections = {}
+        self._slowest = []
+        self._lock = threading.Lock()
+
+        # the Functions worker is long-lived, measure the peak of this run only
+        self._peak_reset = reset_peak_rss()
+
+        self._stage_histogram = None
+        self._file_histogram = None
+        if otel_metrics is not None:
+            meter = otel_metrics.get_meter(METER_NAME)
+            self._stage_histogram = meter.create_histogram(
+                "pipeline.stage.duration", unit="s"
+            )
+            self._file_histogram = meter.create_histogram(
+                "pipeline.file.duration", unit="s"
+            )
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Time a block of work and attribute it to `stage`."""
+        start = time.perf_counter()
+        failed = False
+
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.record_stage(stage, time.perf_counter() - start, failed)
+
+    def record_stage(self, stage, seconds, failed=False):
+        with self._lock:
+            self._record_stage(stage, seconds, failed)
+
+        if self._stage_histogram is not None:
+            self._stage_histogram.record(
+                seconds, {"pipeline": self.pipeline_name, "stage": stage}
+            )
+
+    def record_file(self, path, seconds):
+        if self._file_histogram is not None:
+            self._file_histogram.record(seconds, {"pipeline": self.pipeline_name})
+
+        with self._lock:
+            self.files_processed += 1
+            self._record_stage("file", seconds)
+
+            entry = (seconds, path)
+            if len(self._slowest) < self.top_n:
+                heapq.heappush(self._slowest, entry)
+            elif entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def _record_stage(self, stage, seconds, failed=False):
+        if stage not in self.stages:
+            self.stages[stage] = StageStats(stage)
+        self.stages[stage].record(seconds, failed)
+
+    def add_bytes(self, direction, count):
+        """Count bytes transferred, e.g. `download` or `upload`."""
+        with self._lock:
+            self.bytes[direction] = self.bytes.get(direction, 0) + count
+
+    def increment(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def add_section(self, name, data):
+        """Attach a JSON serialisable report, e.g. storage throughput."""
+        with self._lock:
+            self.sections[name] = data
+
+    def slowest_files(self):
+        with self._lock:
+            return [
+                {"path": path, "seconds": round(seconds, 3)}
+                for seconds, path in sorted(self._slowest, reverse=True)
+            ]
+
+    def summary(self):
+        """Return the run summary as a JSON serialisable dict."""
+        slowest = self.slowest_files()
+
+        with self._lock:
+            return {
+                "pipeline": self.pipeline_name,
+                "workflow_id": self.workflow_id,
+                "wall_seconds": round(time.perf_counter() - self.started, 3),
+                "files_processed": self.files_processed,
+                "peak_memory_bytes": peak_rss_bytes() if self._peak_reset else None,
+                "process_peak_rss_bytes": process_peak_rss_bytes(),
+                "bytes": dict(self.bytes),
+                "counters": dict(self.counters),
+                "stages": {
+                    name: stats.to_dict() for name, stats in self.stages.items()
+                },
+                "slowest_files": slowest,
+                **self.sections,
+            }
+
+    def dumps(self):
+        return json.dumps(self.summary(), indent=4)
+
+    def export(self):
+        """Log the summary and publish it as Application Insights custom metrics.
+
+        Stage and file durations are recorded on their histograms per item as
+        they happen, only the run totals are published here.
+        """
+        summary = self.summary()
+
+        logging.info(
+            "Pipeline %s (%s) finished in %ss, %s files, %s",
+            self.pipeline_name,
+            self.workflow_id,
+            summary["wall_seconds"],
+            summary["files_processed"],
+            summary["bytes"],
+        )
+
+        if otel_metrics is None:
+            return
+
+        meter = otel_metrics.get_meter(METER_NAME)
+        attributes = {"pipeline": self.pipeline_name}
+
+        meter.create_histogram("pipeline.run.duration", unit="s").record(
+            summary["wall_seconds"], attributes
+        )
+        meter.create_counter("pipeline.files").add(
+            summary["files_processed"], attributes
+        )
+
+        if summary["peak_memory_bytes"] is not None:
+            meter.create_histogram("pipeline.peak_memory", unit="By").record(
+                summary["peak_memory_bytes"], attributes
+            )
+
+        byte_counter = meter.create_counter("pipeline.bytes", unit="By")
+        for direction, count in summary["bytes"].items():
+            byte_counter.add(count, {**attributes, "direction": direction})
+
+        event_counter = meter.create_counter("pipeline.events")
+        for counter, value in summary["counters"].items():
+            event_counter.add(value, {**attributes, "event": counter})
+
+
+def span(metrics, stage):
+    """Return `metrics.span(stage)`, or a no-op context if `metrics` is None."""
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.span(stage)
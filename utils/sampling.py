@@ -0,0 +1,82 @@
+"""Reproducible stratified samples of a pipeline listing for validation runs."""
+import random
+
+
+def folder_stratum(root, depth=2):
+    """Return a function mapping a path to its first `depth` folders below `root`.
+
+    Under the pooled data folder these are the device and site folders.
+    """
+    prefix = root.rstrip("/") + "/"
+
+    def stratum_of(path):
+        relative = path.removeprefix(prefix)
+        folders = relative.split("/")[:-1]
+        return "/".join(folders[:depth]) or "."
+
+    return stratum_of
+
+
+def stratified_sample(items, per_stratum, seed, stratum_of, key=None):
+    """Pick up to `per_stratum` items from every stratum.
+
+    Each stratum is sorted and sampled with its own seeded generator, so the
+    sample only depends on the seed and the stratum's content, not on the
+    listing order or on the other strata. Returns `(sample, strata)` where
+    `strata` maps each stratum to its number of listed items.
+    """
+    key = key or (lambda item: item)
+    groups = {}
+
+    for item in items:
+        groups.setdefault(stratum_of(key(item)), []).append(item)
+
+    sample = []
+    strata = {}
+
+    for stratum in sorted(groups):
+        group = sorted(groups[stratum], key=key)
+        strata[stratum] = len(group)
+
+        generator = random.Random(f"{seed}:{stratum}")
+        sample.extend(generator.sample(group, min(per_stratum, len(group))))
+
+    return sample, strata
+
+
+def protocols_of(file_info):
+    """Return the protocols found in a pipeline result."""
+    if isinstance(file_info, dict):
+        if "instances" in file_info:
+            return [
+                instance.get("protocol", "Error") for instance in file_info["instances"]
+            ]
+        return [file_info.get("protocol", "Unknown")]
+
+    return [str(file_info)]
+
+
+class SampleReport:
+    """Per-stratum label distribution of a sampled run."""
+
+    def __init__(self, per_stratum, seed, strata):
+        self.per_stratum = per_stratum
+        self.seed = seed
+        self.strata = {
+            stratum: {"listed": listed, "sampled": 0, "protocols": {}}
+            for stratum, listed in strata.items()
+        }
+
+    def add(self, stratum, labels):
+        entry = self.strata[stratum]
+        entry["sampled"] += 1
+
+        for label in labels:
+            entry["protocols"][label] = entry["protocols"].get(label, 0) + 1
+
+    def to_dict(self):
+        return {
+            "per_stratum": self.per_stratum,
+            "seed": self.seed,
+            "strata": self.strata,
+        }
@@ -0,0 +1,489 @@
+"""Throttle-aware access to the storage account used by the pipelines.
+
+All storage calls made by the stage one pipelines go through `Storage`, which
+wraps a backend with:
+
+- an AIMD concurrency limit that grows while calls succeed and halves when
+  the account starts throttling (503 ServerBusy, 429, 500 OperationTimedOut)
+- jittered exponential backoff retries on throttling, honouring Retry-After,
+  and on transient connection errors, which leave the limit unchanged
+- per-operation rate budgets (token buckets)
+
+`LocalFaultyBackend` serves a local folder and injects throttling errors so
+the controller can be exercised without a storage account.
+"""
+import datetime
+import os
+import random
+import threading
+import time
+
+import azure.storage.blob as azureblob
+import azure.storage.filedatalake as azurelake
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+
+import config
+from utils.instrumentation import span
+
+# A 500 is only throttling with OperationTimedOut, other 500s are server faults
+THROTTLE_STATUS_CODES = (429, 503)
+THROTTLE_ERROR_CODES = ("ServerBusy", "OperationTimedOut", "TooManyRequests")
+
+# Requests per second each pipeline run may send per operation. The account
+# scales to 20,000 requests per second, this leaves room for other workloads
+# and keeps a run from tripping the per-partition limits on its own.
+OPERATION_RATES = {
+    "list": 20,
+    "download_range": 400,
+    "download": 100,
+    "upload": 50,
+}
+
+
+def is_throttle_error(error):
+    """Return True if `error` is a storage throttling response."""
+    error_code = getattr(error, "error_code", None)
+    if error_code in THROTTLE_ERROR_CODES:
+        return True
+
+    status_code = getattr(error, "status_code", None)
+    return status_code in THROTTLE_STATUS_CODES
+
+
+def is_transient_error(error):
+    """Return True for connection failures worth retrying, e.g. a reset."""
+    return isinstance(
+        error,
+        (ServiceRequestError, ServiceResponseError, ConnectionError, TimeoutError),
+    )
+
+
+def retry_after_seconds(error):
+    """Return the Retry-After delay requested by the server, if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveConcurrency:
+    """Additive-increase/multiplicative-decrease limit on in-flight calls."""
+
+    def __init__(self, initial=4, minimum=1, maximum=32, decrease_factor=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self._successes = 0
+        self._epoch = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot and return the epoch to pass to `release`."""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return self._epoch
+
+    def release(self, epoch, throttled=False, transient=False):
+        """Return a slot; `transient` failures neither grow nor shrink the limit."""
+        with self._condition:
+            self.in_flight -= 1
+
+            if throttled:
+                # calls in flight when the account starts throttling all
+                # fail together, back off once for all of them
+                if epoch == self._epoch:
+                    self._epoch += 1
+                    self._successes = 0
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+            elif not transient:
+                self._successes += 1
+
+                # grow by one slot per window of successful calls
+                if self._successes >= self.limit:
+                    self._successes = 0
+                    self.limit = min(self.maximum, self.limit + 1)
+
+            self._condition.notify_all()
+
+
+class RateBudget:
+    """Token bucket allowing `rate` operations per second with bursts."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def default_budgets():
+    """Return a fresh `RateBudget` for every operation in `OPERATION_RATES`."""
+    return {operation: RateBudget(rate) for operation, rate in OPERATION_RATES.items()}
+
+
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.transient = 0
+        self.failed = 0
+        self.bytes = 0
+
+
+class Storage:
+    """Throttle-aware facade over a storage backend."""
+
+    def __init__(
+        self,
+        backend,
+        concurrency=None,
+        budgets=None,
+        max_retries=8,
+        base_delay=0.5,
+        max_delay=30.0,
+        metrics=None,
+    ):
+        self.backend = backend
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        self.budgets = budgets or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics
+        self.stats = {}
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def iter_files(self, path):
+        """Yield `(name, size, etag)` for all files below `path` page by page.
+
+        A throttled page is retried from its continuation token, so the
+        listing is never held in memory as a whole.
+        """
+        continuation_token = None
+
+        while True:
+            with span(self.metrics, "list"):
+                files, continuation_token = self.call(
+                    "list", self.backend.list_page, path, continuation_token
+                )
+            yield from files
+
+            if not continuation_token:
+                return
+
+    def download(self, path):
+        data = self.call("download", self.backend.download, path)
+        self._count_bytes("download", len(data))
+        return data
+
+    def download_range(self, path, offset, length):
+        """Return `length` bytes of `path` starting at `offset`."""
+        data = self.call(
+            "download_range", self.backend.download_range, path, offset, length
+        )
+        self._count_bytes("download_range", len(data))
+        return data
+
+    def upload(self, path, data):
+        self.call("upload", self.backend.upload, path, data)
+        self._count_bytes("upload", len(data))
+
+    def upload_file(self, path, local_path):
+        """Upload a local file, streaming it instead of reading it into memory."""
+
+        def upload():
+            # reopened on every attempt so retries start from the beginning
+            with open(local_path, "rb") as data:
+                self.backend.upload(path, data)
+
+        self.call("upload", upload)
+        self._count_bytes("upload", os.path.getsize(local_path))
+
+    def call(self, operation, function, *args):
+        """Run `function` under the concurrency limit, retrying throttling and resets."""
+        budget = self.budgets.get(operation)
+        stats = self._stats(operation)
+
+        attempt = 0
+        while True:
+            if budget is not None:
+                budget.acquire()
+
+            epoch = self.concurrency.acquire()
+            try:
+                result = function(*args)
+            except Exception as error:
+                throttled = is_throttle_error(error)
+                transient = not throttled and is_transient_error(error)
+                self.concurrency.release(
+                    epoch, throttled=throttled, transient=transient
+                )
+
+                if self.metrics is not None:
+                    if throttled:
+                        self.metrics.increment(f"storage.{operation}.throttled")
+                    elif transient:
+                        self.metrics.increment(f"storage.{operation}.transient")
+
+                with self._lock:
+                    stats.throttled += throttled
+                    stats.transient += transient
+                    retryable = throttled or transient
+                    if not retryable or attempt >= self.max_retries:
+                        stats.failed += 1
+                        raise
+                    stats.retries += 1
+
+                time.sleep(self._backoff(attempt, error))
+                attempt += 1
+                continue
+
+            self.concurrency.release(epoch)
+            with self._lock:
+                stats.calls += 1
+            return result
+
+    def _backoff(self, attempt, error):
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return retry_after
+
+        # full jitter keeps retrying workers from synchronising
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def _stats(self, operation):
+        with self._lock:
+            if operation not in self.stats:
+                self.stats[operation] = OperationStats()
+            return self.stats[operation]
+
+    def _count_bytes(self, operation, count):
+        with self._lock:
+            self.stats[operation].bytes += count
+
+        if self.metrics is not None:
+            self.metrics.add_bytes(operation, count)
+
+    def report(self):
+        """Return achieved throughput against throttle events per operation."""
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+
+        with self._lock:
+            return {
+                "concurrency_limit": int(self.concurrency.limit),
+                "operations": {
+                    operation: {
+                        "calls": stats.calls,
+                        "calls_per_second": round(stats.calls / elapsed, 3),
+                        "bytes": stats.bytes,
+                        "bytes_per_second": round(stats.bytes / elapsed, 1),
+                        "throttled": stats.throttled,
+                        "transient": stats.transient,
+                        "retries": stats.retries,
+                        "failed": stats.failed,
+                    }
+                    for operation, stats in self.stats.items()
+                },
+            }
+
+
+class AzureBackend:
+    """Storage backend for a container of the b2aistaging account."""
+
+    def __init__(self, blob_service_client, file_system_client, container):
+        self.blob_service_client = blob_service_client
+        self.file_system_client = file_system_client
+        self.container = container
+
+    @classmethod
+    def from_config(cls, container="stage-1-container"):
+        """Create the clients from the account key and connection string."""
+        sas_token = azureblob.generate_account_sas(
+            account_name="b2aistaging",
+            account_key=config.AZURE_STORAGE_ACCESS_KEY,
+            resource_types=azureblob.ResourceTypes(container=True, object=True),
+            permission=azureblob.AccountSasPermissions(
+                read=True, write=True, list=True
+            ),
+            expiry=datetime.datetime.now(datetime.timezone.utc)
+            + datetime.timedelta(hours=1),
+        )
+
+        # retries are left to Storage so throttling reaches the concurrency
+        # controller immediately instead of after the SDK's own backoff;
+        # Storage also retries dropped connections and timeouts
+        blob_service_client = azureblob.BlobServiceClient(
+            account_url="https://b2aistaging.blob.core.windows.net/",
+            credential=sas_token,
+            retry_total=0,
+        )
+
+        file_system_client = azurelake.FileSystemClient.from_connection_string(
+            config.AZURE_STORAGE_CONNECTION_STRING,
+            file_system_name=container,
+            retry_total=0,
+        )
+
+        return cls(blob_service_client, file_system_client, container)
+
+    def list_page(self, path, continuation_token=None):
+        pages = self.file_system_client.get_paths(path=path).by_page(
+            continuation_token=continuation_token
+        )
+        page = next(pages, [])
+
+        files = [
+            (str(p.name), p.content_length, p.etag) for p in page if not p.is_directory
+        ]
+        return files, pages.continuation_token
+
+    def download(self, path):
+        blob_client = self.blob_service_client.get_blob_client(
+            container=self.container, blob=path
+        )
+        return blob_client.download_blob().readall()
+
+    def download_range(self, path, offset, length):
+        blob_client = self.blob_service_client.get_blob_client(
+            container=self.container, blob=path
+        )
+        return blob_client.download_blob(offset=offset, length=length).readall()
+
+    def upload(self, path, data):
+        blob_client = self.blob_service_client.get_blob_client(
+            container=self.container, blob=path
+        )
+        blob_client.upload_blob(data)
+
+
+class ThrottledError(Exception):
+    """Throttling response raised by `LocalFaultyBackend`."""
+
+    def __init__(self, status_code=503, error_code="ServerBusy"):
+        super().__init__(f"{status_code} {error_code}")
+        self.status_code = status_code
+        self.error_code = error_code
+
+
+class LocalFaultyBackend:
+    """Local folder stand-in for `AzureBackend` that injects throttling.
+
+    Calls fail with `ThrottledError` with probability `throttle_rate`, and
+    always once more than `capacity` calls are in flight, which mimics an
+    account that throttles when driven too hard.
+    """
+
+    def __init__(self, root, throttle_rate=0.0, capacity=None, latency=0.0, seed=0):
+        self.root = root
+        self.throttle_rate = throttle_rate
+        self.capacity = capacity
+        self.latency = latency
+        self.in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _enter(self):
+        with self._lock:
+            self.in_flight += 1
+            overloaded = self.capacity is not None and self.in_flight > self.capacity
+            unlucky = self._random.random() < self.throttle_rate
+
+        if overloaded or unlucky:
+            self._exit()
+            raise ThrottledError()
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _exit(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _local_path(self, path):
+        return os.path.join(self.root, *path.split("/"))
+
+    def list_files(self, path):
+        self._enter()
+        try:
+            files = []
+            for root, _, names in os.walk(self._local_path(path)):
+                for name in names:
+                    local_path = os.path.join(root, name)
+                    relative = os.path.relpath(local_path, self.root)
+                    stat = os.stat(local_path)
+                    files.append(
+                        (
+                            relative.replace(os.sep, "/"),
+                            stat.st_size,
+                            f'"{stat.st_mtime_ns:x}"',
+                        )
+                    )
+            return sorted(files)
+        finally:
+            self._exit()
+
+    def list_page(self, path, continuation_token=None, page_size=1000):
+        files = self.list_files(path)
+        start = int(continuation_token or 0)
+        end = start + page_size
+        return files[start:end], str(end) if end < len(files) else None
+
+    def download(self, path):
+        self._enter()
+        try:
+            with open(self._local_path(path), "rb") as f:
+                return f.read()
+        finally:
+            self._exit()
+
+    def download_range(self, path, offset, length):
+        self._enter()
+        try:
+            with open(self._local_path(path), "rb") as f:
+                f.seek(offset)
+                return f.read(length)
+        finally:
+            self._exit()
+
+    def upload(self, path, data):
+        self._enter()
+        try:
+            local_path = self._local_path(path)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            elif hasattr(data, "read"):
+                data = data.read()
+
+            with open(local_path, "xb") as f:
+                f.write(data)
+        finally:
+            self._exit()
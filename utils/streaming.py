@@ -0,0 +1,216 @@
+"""Streaming stage framework for the stage one pipelines.
+
+A pipeline is a source iterable, a chain of stages and a sink. Every stage
+runs on its own pool of worker threads and hands items to the next stage
+through a bounded queue, so a slow stage holds back the stages before it
+instead of letting items pile up in memory. Stages with several workers
+may reorder items.
+
+A stage function takes one item and returns an iterable of output items:
+yield one item to transform it, none to drop it or several to expand it.
+"""
+import json
+import queue
+import threading
+import time
+
+# Marks the end of the stream for one worker
+DONE = object()
+
+POLL_SECONDS = 0.1
+
+
+class Stage:
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+
+class StreamingPipeline:
+    """Run `source` through `stages` into `sink` with bounded queues.
+
+    The first exception raised by the source, a stage or the sink stops the
+    pipeline and is re-raised by `run`. Items that were produced but not
+    consumed when it stopped are passed to `discard`, so resources they hold
+    can be released. Time spent in each stage function is recorded per item
+    on `metrics` under the stage name.
+    """
+
+    def __init__(self, source, stages, sink, queue_size=16, metrics=None, discard=None):
+        self.source = source
+        self.stages = stages
+        self.sink = sink
+        self.queue_size = queue_size
+        self.metrics = metrics
+        self.discard = discard
+        self._stop = threading.Event()
+        self._error = None
+        self._lock = threading.Lock()
+
+    def run(self):
+        inboxes = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        sink_inbox = queue.Queue(maxsize=self.queue_size)
+        outboxes = inboxes[1:] + [sink_inbox]
+        downstream_workers = [stage.workers for stage in self.stages[1:]] + [1]
+
+        threads = [
+            threading.Thread(
+                target=self._feed,
+                args=(
+                    inboxes[0] if self.stages else sink_inbox,
+                    self.stages[0].workers if self.stages else 1,
+                ),
+                daemon=True,
+            )
+        ]
+
+        for stage, inbox, outbox, workers in zip(
+            self.stages, inboxes, outboxes, downstream_workers
+        ):
+            remaining = [stage.workers]
+
+            for _ in range(stage.workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._work,
+                        args=(stage, inbox, outbox, workers, remaining),
+                        name=f"{stage.name}-worker",
+                        daemon=True,
+                    )
+                )
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(sink_inbox)
+                if item is DONE:
+                    break
+                self.sink(item)
+        except Exception as error:
+            # stops the workers too
+            self._fail(error)
+
+        for thread in threads:
+            thread.join()
+
+        # items still queued when the pipeline stopped
+        for inbox in inboxes + [sink_inbox]:
+            while True:
+                try:
+                    self._discard(inbox.get_nowait())
+                except queue.Empty:
+                    break
+
+        if self._error is not None:
+            raise self._error
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
+
+    def _get(self, inbox):
+        """Return the next item, or DONE once the pipeline has stopped."""
+        while not self._stop.is_set():
+            try:
+                return inbox.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return DONE
+
+    def _put(self, outbox, item):
+        """Wait for room in `outbox`, returning False if the pipeline stopped."""
+        while not self._stop.is_set():
+            try:
+                outbox.put(item, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _discard(self, item):
+        if self.discard is not None and item is not DONE:
+            self.discard(item)
+
+    def _feed(self, outbox, workers):
+        try:
+            for item in self.source:
+                if not self._put(outbox, item):
+                    self._discard(item)
+                    return
+        except Exception as error:
+            self._fail(error)
+            return
+
+        for _ in range(workers):
+            self._put(outbox, DONE)
+
+    def _work(self, stage, inbox, outbox, downstream_workers, remaining):
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is DONE:
+                    break
+
+                outputs = iter(stage.function(item))
+                elapsed = 0.0
+
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        output = next(outputs)
+                    except StopIteration:
+                        break
+                    finally:
+                        elapsed += time.perf_counter() - start
+
+                    if not self._put(outbox, output):
+                        self._discard(output)
+                        return
+
+                if self.metrics is not None:
+                    self.metrics.record_stage(stage.name, elapsed)
+        except Exception as error:
+            self._fail(error)
+        finally:
+            with self._lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+
+            # the last worker of a stage closes the stream for the next one
+            if last and not self._stop.is_set():
+                for _ in range(downstream_workers):
+                    self._put(outbox, DONE)
+
+
+class JsonArrayWriter:
+    """Write records to a JSON array file one at a time.
+
+    The output matches `json.dumps(records, indent=4)` without holding all
+    records in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path, mode="w", encoding="utf-8")
+        self._file.write("[")
+
+    def write(self, record):
+        text = json.dumps(record, indent=4).replace("\n", "\n    ")
+        self._file.write(("," if self.count else "") + "\n    " + text)
+        self.count += 1
+
+    def close(self):
+        self._file.write("\n]" if self.count else "]")
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()